@@ -0,0 +1,165 @@
+"""
+Maintenance of, and lookups against, the precomputed date archive
+index stored in the ``ArchiveDay`` model.
+
+Date-based navigation (lists of years, months or days which have
+entries) is read from here instead of being computed with
+``DISTINCT`` date queries over the entry table.
+
+"""
+
+import datetime
+
+from django.db import connection
+
+
+class ArchivePeriod(object):
+    """
+    A year, month or day in the archive, along with the number of
+    live Entries published in it.
+    
+    """
+    def __init__(self, date, entry_count):
+        self.date = date
+        self.entry_count = entry_count
+
+    def __repr__(self):
+        return '<ArchivePeriod: %s (%s)>' % (self.date, self.entry_count)
+
+
+def _category_join_sql():
+    """
+    Returns the qualified category and publication date columns, and
+    the ``FROM`` and ``WHERE`` clauses, of a query over live Entries
+    joined to their categories.
+    
+    """
+    from coltrane.models import Entry
+    qn = connection.ops.quote_name
+    field = Entry._meta.get_field('categories')
+    m2m_table, entry_table = qn(field.m2m_db_table()), qn(Entry._meta.db_table)
+    category_column = '%s.%s' % (m2m_table, qn(field.m2m_reverse_name()))
+    date_column = '%s.%s' % (entry_table, qn('pub_date'))
+    from_where = "FROM %s INNER JOIN %s ON %s.%s = %s.%s WHERE %s.%s = %%s" % \
+                 (m2m_table, entry_table,
+                  entry_table, qn(Entry._meta.pk.column),
+                  m2m_table, qn(field.m2m_column_name()),
+                  entry_table, qn('status'))
+    return category_column, date_column, from_where
+
+def refresh_days(days):
+    """
+    Recounts the live Entries published on each of ``days`` (a
+    sequence of ``datetime.date`` objects), overall and per Category,
+    and replaces the ``ArchiveDay`` rows for those days.
+    
+    """
+    from coltrane.models import ArchiveDay, Entry
+    category_column, date_column, from_where = _category_join_sql()
+    sql = "SELECT %s, COUNT(*) %s AND %s BETWEEN %%s AND %%s GROUP BY %s" % \
+          (category_column, from_where, date_column, category_column)
+    cursor = connection.cursor()
+    for day in set(days):
+        start = datetime.datetime.combine(day, datetime.time.min)
+        end = datetime.datetime.combine(day, datetime.time.max)
+        ArchiveDay.objects.filter(date=day).delete()
+        total = Entry.live.filter(pub_date__range=(start, end)).count()
+        if not total:
+            continue
+        ArchiveDay.objects.create(date=day, entry_count=total)
+        cursor.execute(sql, [Entry.LIVE_STATUS, start, end])
+        for category_id, count in cursor.fetchall():
+            ArchiveDay.objects.create(category_id=category_id, date=day, entry_count=count)
+
+def rebuild_archive_index():
+    """
+    Throws away the whole archive index and rebuilds it from the
+    entry table.
+    
+    """
+    from coltrane.models import ArchiveDay, Entry
+    ArchiveDay.objects.all().delete()
+    totals = {}
+    for pub_date in Entry.live.values_list('pub_date', flat=True).iterator():
+        day = pub_date.date()
+        totals[day] = totals.get(day, 0) + 1
+    for day, count in totals.items():
+        ArchiveDay.objects.create(date=day, entry_count=count)
+    by_category = {}
+    category_column, date_column, from_where = _category_join_sql()
+    cursor = connection.cursor()
+    cursor.execute("SELECT %s, %s %s" % (category_column, date_column, from_where), [Entry.LIVE_STATUS])
+    for category_id, pub_date in cursor.fetchall():
+        key = (category_id, pub_date.date())
+        by_category[key] = by_category.get(key, 0) + 1
+    for (category_id, day), count in by_category.items():
+        ArchiveDay.objects.create(category_id=category_id, date=day, entry_count=count)
+
+def update_archive_index(sender, instance, **kwargs):
+    """
+    Signal handler which refreshes the archive index for the day an
+    Entry is published on, and for the day it used to be published
+    on if that changed, whenever the Entry is saved or deleted.
+
+    On save it's called through ``coltrane.deferred``, so that the
+    per-Category counts include categories the admin writes after
+    saving the Entry.
+    
+    """
+    original = getattr(instance, '_original_state', None)
+    if instance.status != instance.LIVE_STATUS and \
+       (original is None or original['status'] != instance.LIVE_STATUS):
+        return
+    days = [instance.pub_date.date()]
+    if original is not None:
+        days.append(original['pub_date'].date())
+    refresh_days(days)
+
+def archive_periods(kind, category=None, year=None, month=None, allow_future=True):
+    """
+    Returns a list, in chronological order, of ``ArchivePeriod``
+    objects for each year, month or day (according to ``kind``, which
+    must be one of 'year', 'month' or 'day') which has live Entries.
+
+    The list can be restricted to Entries in a given ``category``,
+    and to a given ``year`` and ``month``. Unless ``allow_future`` is
+    ``True``, days after the current date are left out.
+
+    The ``date`` of each period is a ``datetime.datetime``, as in the
+    ``date_list`` of the generic date-based views.
+    
+    """
+    from coltrane.models import ArchiveDay
+    if kind not in ('year', 'month', 'day'):
+        raise ValueError("archive period must be 'year', 'month' or 'day', not '%s'" % kind)
+    days = ArchiveDay.objects.all()
+    if category is None:
+        days = days.filter(category__isnull=True)
+    else:
+        days = days.filter(category__pk=category.id)
+    if year is not None:
+        days = days.filter(date__year=int(year))
+    if month is not None:
+        days = days.filter(date__month=int(month))
+    if not allow_future:
+        days = days.filter(date__lte=datetime.date.today())
+    totals = {}
+    for day, count in days.values_list('date', 'entry_count'):
+        if kind == 'year':
+            key = datetime.datetime(day.year, 1, 1)
+        elif kind == 'month':
+            key = datetime.datetime(day.year, day.month, 1)
+        else:
+            key = datetime.datetime(day.year, day.month, day.day)
+        totals[key] = totals.get(key, 0) + count
+    keys = totals.keys()
+    keys.sort()
+    return [ArchivePeriod(key, totals[key]) for key in keys]
+
+def archive_dates(kind, **kwargs):
+    """
+    Like ``archive_periods``, but returns only the dates, for use as
+    a ``date_list``.
+    
+    """
+    return [period.date for period in archive_periods(kind, **kwargs)]
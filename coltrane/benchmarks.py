@@ -0,0 +1,236 @@
+"""
+A benchmark suite for coltrane's views and template tags.
+
+``seed_blog`` fills the database with a synthetic weblog, and
+``benchmark_urls`` and ``benchmark_template_tags`` then time requests
+to every entry and category URL, and renders of the featured-entry
+tags, recording the number of queries each made. Any of them which
+goes over its query budget is reported by ``check_budgets``.
+
+Budgets are the maximum number of queries, keyed by URL name or tag
+name, in ``DEFAULT_QUERY_BUDGETS``, overridden by the
+``COLTRANE_QUERY_BUDGETS`` setting.
+
+Run the suite with ``manage.py coltrane_benchmark``, which seeds a
+fresh test database so that real data is never touched.
+
+"""
+
+import datetime
+import math
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.urlresolvers import reverse
+from django.db import connection, reset_queries, transaction
+from django.template import Context, Template
+from django.test.client import Client
+
+from coltrane.bulk import bulk_insert
+from coltrane.caching import bump_category_generation, bump_entry_generation
+from coltrane.pagecache import purge
+
+
+DEFAULT_QUERY_BUDGETS = {
+    'coltrane_entry_archive_index': 10,
+    'coltrane_entry_archive_year': 10,
+    'coltrane_entry_archive_month': 10,
+    'coltrane_entry_archive_day': 10,
+    'coltrane_entry_detail': 10,
+    'coltrane_category_list': 5,
+    'coltrane_category_detail': 10,
+    'get_featured_entries': 2,
+    'get_featured_entry': 2,
+    }
+
+TEMPLATE_TAGS = (
+    ('get_featured_entries', '{% load coltrane %}{% get_featured_entries 5 as entries %}{% for entry in entries %}{{ entry.title }}{% endfor %}'),
+    ('get_featured_entry', '{% load coltrane %}{% get_featured_entry as entry %}{{ entry.title }}'),
+    )
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipisicing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud '
+         'exercitation ullamco laboris nisi aliquip ex ea commodo consequat').split()
+
+
+def _text(rng, num_words):
+    return u' '.join([rng.choice(WORDS) for i in range(num_words)])
+
+def _comment(comment_model, ctype, entry, user, text, submit_date):
+    from django.contrib.comments.models import FreeComment
+    if comment_model is FreeComment:
+        return FreeComment(content_type=ctype, object_id=entry.id, comment=text,
+                           person_name=u'Benchmark', submit_date=submit_date,
+                           is_public=True, ip_address='127.0.0.1', approved=True,
+                           site_id=settings.SITE_ID)
+    return comment_model(content_type=ctype, object_id=entry.id, user=user, headline=u'',
+                         comment=text, submit_date=submit_date, is_public=True,
+                         ip_address='127.0.0.1', is_removed=False, valid_rating=False,
+                         site_id=settings.SITE_ID)
+
+def seed_blog(entries=500, categories=10, tags=100, comments=2000, random_seed=0):
+    """
+    Fills the database with a synthetic weblog: ``entries`` Entries
+    spread over the last three years (about one in ten a draft, and
+    one in twenty featured), each in one to three of ``categories``
+    Categories and with up to five of ``tags`` tags, and ``comments``
+    comments spread over the live Entries.
+
+    Entries are saved normally, so that their HTML and denormalized
+    data are built as they would be in use; comments are inserted in
+    bulk, bypassing moderation. All the denormalized data is rebuilt
+    at the end, so that it reflects the categories added after each
+    Entry was saved.
+    
+    """
+    from coltrane.models import Category, Entry, get_comment_model
+    from coltrane.management.commands.coltrane_rebuild import REBUILDERS
+    rng = random.Random(random_seed)
+    author = User.objects.create_user('benchmark', 'benchmark@example.com', 'benchmark')
+    category_list = []
+    for i in range(categories):
+        category = Category(title=u'Category %d' % i, slug=u'category-%d' % i,
+                            description=_text(rng, 20))
+        category.save()
+        category_list.append(category)
+    tag_names = [u'tag%d' % i for i in range(tags)]
+    now = datetime.datetime.now()
+    live = []
+    for i in range(entries):
+        status = rng.random() < 0.1 and Entry.DRAFT_STATUS or Entry.LIVE_STATUS
+        entry = Entry(author=author, title=u'Entry %d' % i, slug=u'entry-%d' % i,
+                      pub_date=now - datetime.timedelta(seconds=rng.randint(0, 3 * 365 * 86400)),
+                      status=status, featured=rng.random() < 0.05,
+                      excerpt=_text(rng, 30), body=u'\n\n'.join([_text(rng, 60) for j in range(5)]),
+                      tags=u' '.join(rng.sample(tag_names, min(rng.randint(0, 5), len(tag_names)))))
+        entry.save()
+        for category in rng.sample(category_list, min(rng.randint(1, 3), len(category_list))):
+            entry.categories.add(category)
+        if status == Entry.LIVE_STATUS:
+            live.append(entry)
+    if live:
+        comment_model = get_comment_model()
+        ctype = ContentType.objects.get_for_model(Entry)
+        bulk_insert(comment_model,
+                    [_comment(comment_model, ctype, rng.choice(live), author, _text(rng, 40),
+                              now - datetime.timedelta(seconds=rng.randint(0, 86400 * 30)))
+                     for i in range(comments)])
+        transaction.commit_unless_managed()
+    for name, func in REBUILDERS:
+        func()
+
+
+class Timing(object):
+    """
+    The latencies, in seconds, and query counts of repeated runs of
+    one benchmark.
+    
+    """
+    def __init__(self, name, budget_name):
+        self.name = name
+        self.budget_name = budget_name
+        self.latencies = []
+        self.queries = []
+
+    def add(self, latency, queries):
+        self.latencies.append(latency)
+        self.queries.append(queries)
+
+    def percentile(self, percent):
+        """
+        Returns the latency below which ``percent`` per cent of the
+        runs fell, by the nearest-rank method.
+        
+        """
+        latencies = list(self.latencies)
+        latencies.sort()
+        rank = int(math.ceil(percent / 100.0 * len(latencies))) - 1
+        return latencies[max(0, min(rank, len(latencies) - 1))]
+
+    def max_queries(self):
+        return max(self.queries)
+
+
+def _clear_caches():
+    bump_entry_generation()
+    bump_category_generation()
+    purge('all')
+
+def _time(timing, func, repeat):
+    for i in range(repeat):
+        reset_queries()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        timing.add(elapsed, len(connection.queries))
+
+def benchmark_paths():
+    """
+    Returns a list of ``(URL name, path)`` pairs covering every
+    entry and category URL, using the most recent live Entry and the
+    first Category.
+    
+    """
+    from coltrane.models import Category, Entry
+    entry = Entry.live.latest()
+    date_kwargs = { 'year': entry.pub_date.strftime('%Y'),
+                    'month': entry.pub_date.strftime('%b').lower(),
+                    'day': entry.pub_date.strftime('%d') }
+    paths = [('coltrane_entry_archive_index', {}),
+             ('coltrane_entry_archive_year', { 'year': date_kwargs['year'] }),
+             ('coltrane_entry_archive_month', { 'year': date_kwargs['year'], 'month': date_kwargs['month'] }),
+             ('coltrane_entry_archive_day', date_kwargs),
+             ('coltrane_entry_detail', dict(date_kwargs, slug=entry.slug)),
+             ('coltrane_category_list', {}),
+             ('coltrane_category_detail', { 'slug': Category.objects.all()[0].slug })]
+    return [(name, reverse(name, kwargs=kwargs)) for name, kwargs in paths]
+
+def benchmark_urls(repeat=20):
+    """
+    Requests each of ``benchmark_paths`` ``repeat`` times through the
+    test client, returning a list of ``Timing`` objects. The first
+    request to each starts with nothing cached.
+    
+    """
+    client = Client()
+    timings = []
+    for name, path in benchmark_paths():
+        _clear_caches()
+        timing = Timing(path, name)
+        def request():
+            response = client.get(path)
+            if response.status_code != 200:
+                raise AssertionError('%s returned status %s' % (path, response.status_code))
+        _time(timing, request, repeat)
+        timings.append(timing)
+    return timings
+
+def benchmark_template_tags(repeat=20):
+    """
+    Renders each of the featured-entry template tags ``repeat``
+    times, returning a list of ``Timing`` objects.
+    
+    """
+    timings = []
+    for name, source in TEMPLATE_TAGS:
+        _clear_caches()
+        template = Template(source)
+        timing = Timing('{%% %s %%}' % name, name)
+        _time(timing, lambda: template.render(Context()), repeat)
+        timings.append(timing)
+    return timings
+
+def check_budgets(timings):
+    """
+    Returns a list of ``(timing, budget)`` pairs for each of
+    ``timings`` whose most expensive run made more queries than its
+    budget allows.
+    
+    """
+    budgets = dict(DEFAULT_QUERY_BUDGETS)
+    budgets.update(getattr(settings, 'COLTRANE_QUERY_BUDGETS', {}))
+    return [(timing, budgets[timing.budget_name]) for timing in timings
+            if timing.budget_name in budgets and timing.max_queries() > budgets[timing.budget_name]]
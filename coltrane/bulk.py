@@ -0,0 +1,46 @@
+"""
+Helpers for writing many rows at once, bypassing ``save()`` and its
+signals; whatever the signal handlers would have maintained has to be
+rebuilt afterwards (see ``manage.py coltrane_rebuild``).
+
+"""
+
+from django.db import connection
+
+
+def bulk_insert(model, objects):
+    """
+    Inserts unsaved ``objects`` of ``model`` with a single
+    ``executemany``. Primary keys are inserted too if the objects
+    have them, and left to the database otherwise.
+    
+    """
+    objects = list(objects)
+    if not objects:
+        return
+    qn = connection.ops.quote_name
+    pk = model._meta.pk
+    fields = [f for f in model._meta.fields if f is not pk or objects[0].pk is not None]
+    rows = [[f.get_db_prep_save(f.pre_save(obj, True)) for f in fields] for obj in objects]
+    cursor = connection.cursor()
+    cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % \
+                       (qn(model._meta.db_table),
+                        ', '.join([qn(f.column) for f in fields]),
+                        ', '.join(['%s'] * len(fields))),
+                       rows)
+
+def bulk_insert_rows(table, columns, rows):
+    """
+    Inserts ``rows``, sequences of values for ``columns``, into
+    ``table`` with a single ``executemany``; for tables with no model
+    of their own, such as many-to-many join tables.
+    
+    """
+    if not rows:
+        return
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % \
+                       (qn(table), ', '.join([qn(column) for column in columns]),
+                        ', '.join(['%s'] * len(columns))),
+                       rows)
@@ -0,0 +1,151 @@
+"""
+Helpers for caching Categories and data derived from Entries.
+
+Anything cached under a key built by ``entry_cache_key`` is tied to
+the current Entry "generation", which is changed whenever any Entry
+is saved or deleted; old keys are then simply never read again, and
+expire from the cache on their own. Categories are cached the same
+way, under a separate generation changed whenever any Category is
+saved or deleted.
+
+This only works if every process serving the site shares the cache
+backend, so that a new generation started by one process is seen by
+all the others. With a per-process backend ('locmem', 'simple') or
+the 'dummy' backend, ``is_shared`` returns ``False`` and coltrane's
+caches (of neighbors, featured entries, Categories and whole pages)
+are turned off. Set ``COLTRANE_SHARED_CACHE`` to override the check,
+for example to ``True`` for a single-process server using 'locmem'.
+
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+GENERATION_KEY = 'coltrane.entry.generation'
+CATEGORY_GENERATION_KEY = 'coltrane.category.generation'
+
+# Generations are only replaced, never expired on purpose; this is
+# the longest timeout every cache backend accepts as a duration.
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+# Categories fetched by this process, keyed by slug, each with the
+# generation it was fetched in.
+_local_categories = {}
+
+_category_stats = { 'local_hits': 0, 'cache_hits': 0, 'misses': 0 }
+
+# Cache backends whose contents belong to one process, or which keep
+# nothing at all.
+UNSHARED_BACKENDS = ('locmem', 'simple', 'dummy')
+
+
+def is_shared():
+    """
+    Returns ``True`` if the cache backend is shared by every process
+    serving the site, judging by the scheme of ``CACHE_BACKEND``
+    unless the ``COLTRANE_SHARED_CACHE`` setting says otherwise.
+    
+    """
+    shared = getattr(settings, 'COLTRANE_SHARED_CACHE', None)
+    if shared is None:
+        shared = settings.CACHE_BACKEND.split(':', 1)[0] not in UNSHARED_BACKENDS
+    return shared
+
+def _bump_generation(key):
+    generation = '%.6f' % time.time()
+    cache.set(key, generation, GENERATION_TIMEOUT)
+    return generation
+
+def _current_generation(key):
+    generation = cache.get(key)
+    if generation is None:
+        generation = _bump_generation(key)
+    return generation
+
+def bump_entry_generation(sender=None, instance=None, **kwargs):
+    """
+    Starts a new Entry generation, invalidating everything cached
+    under the previous one, and returns it.
+
+    This is connected as a signal handler for Entry saves and
+    deletions.
+    
+    """
+    return _bump_generation(GENERATION_KEY)
+
+def entry_generation():
+    """
+    Returns the current Entry generation.
+    
+    """
+    return _current_generation(GENERATION_KEY)
+
+def entry_cache_key(name):
+    """
+    Returns a cache key for ``name`` in the current Entry generation.
+    
+    """
+    return 'coltrane.entry.%s.%s' % (entry_generation(), name)
+
+def bump_category_generation(sender=None, instance=None, **kwargs):
+    """
+    Starts a new Category generation, invalidating every cached
+    Category, and returns it.
+    
+    This is connected as a signal handler for Category saves and
+    deletions.
+    
+    """
+    return _bump_generation(CATEGORY_GENERATION_KEY)
+
+def category_generation():
+    """
+    Returns the current Category generation.
+    
+    """
+    return _current_generation(CATEGORY_GENERATION_KEY)
+
+def get_category(slug):
+    """
+    Returns the Category with the given slug, raising
+    ``Category.DoesNotExist`` if there isn't one.
+    
+    Categories are looked up in this process's memory first, then in
+    the cache backend, and only then in the database; either cached
+    copy is used only if it belongs to the current Category
+    generation. Without a shared cache backend, every lookup goes to
+    the database. Use the returned Category only for reading.
+    
+    """
+    from coltrane.models import Category
+    if not is_shared():
+        _category_stats['misses'] += 1
+        return Category.objects.get(slug__exact=slug)
+    generation = category_generation()
+    local = _local_categories.get(slug)
+    if local is not None and local[0] == generation:
+        _category_stats['local_hits'] += 1
+        return local[1]
+    key = 'coltrane.category.%s.%s' % (generation, slug)
+    category = cache.get(key)
+    if category is None:
+        _category_stats['misses'] += 1
+        category = Category.objects.get(slug__exact=slug)
+        cache.set(key, category, GENERATION_TIMEOUT)
+    else:
+        _category_stats['cache_hits'] += 1
+    _local_categories[slug] = (generation, category)
+    return category
+
+def category_cache_stats():
+    """
+    Returns a dictionary counting, since this process started, the
+    Category lookups answered from its memory ('local_hits'), from
+    the cache backend ('cache_hits') and from the database
+    ('misses').
+    
+    """
+    return dict(_category_stats)
@@ -0,0 +1,272 @@
+"""
+Helpers for HTTP conditional requests: sending ``Last-Modified`` and
+``ETag`` headers, and answering ``If-Modified-Since`` and
+``If-None-Match`` with a 304 response.
+
+The validators for coltrane's views are computed from the entries
+each page shows, with a couple of cheap queries, so that unchanged
+pages are never rendered for clients which already have them.
+
+An Entry which leaves a page (by being deleted, or moved to another
+date, Category or tag) takes its modification time with it, so the
+time of the latest such removal is kept in the cache and counts as a
+modification of every page. That needs a cache backend shared by
+every process (see ``coltrane.caching.is_shared``); without one, list
+pages send only an ``ETag``, and the generations which validators
+otherwise include are replaced with values read from the database.
+
+"""
+
+import datetime
+import time
+from email.Utils import formatdate, mktime_tz, parsedate_tz
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.encoding import smart_str
+
+from coltrane.caching import GENERATION_TIMEOUT, is_shared
+
+
+REMOVAL_KEY = 'coltrane.conditional.last_removal'
+
+
+def http_date(value):
+    """
+    Formats ``value``, a ``datetime.datetime`` in the server's local
+    time, as an HTTP date.
+    
+    """
+    return formatdate(time.mktime(value.timetuple()), usegmt=True)
+
+def make_etag(*parts):
+    """
+    Returns a quoted entity tag built from a hash of ``parts``.
+    
+    """
+    return '"%s"' % md5('|'.join([smart_str(part) for part in parts])).hexdigest()
+
+def is_not_modified(request, last_modified=None, etag=None):
+    """
+    Returns ``True`` if ``request`` is a conditional GET or HEAD which
+    the client's cached copy satisfies, given the resource's
+    ``last_modified`` (a ``datetime.datetime``) and ``etag``.
+    
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_none_match is None and if_modified_since is None:
+        return False
+    if if_none_match is not None:
+        if etag is None or (if_none_match.strip() != '*' and \
+                            etag not in [tag.strip() for tag in if_none_match.split(',')]):
+            return False
+    if if_modified_since is not None:
+        parsed = parsedate_tz(if_modified_since)
+        if parsed is None or last_modified is None or \
+           int(time.mktime(last_modified.timetuple())) > mktime_tz(parsed):
+            return False
+    return True
+
+def not_modified_response(last_modified=None, etag=None):
+    """
+    Returns a 304 response carrying the validators.
+    
+    """
+    response = HttpResponseNotModified()
+    set_validators(response, last_modified, etag)
+    return response
+
+def set_validators(response, last_modified=None, etag=None):
+    """
+    Sets the ``Last-Modified`` and ``ETag`` headers of ``response``.
+    
+    """
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    if etag is not None:
+        response['ETag'] = etag
+    return response
+
+def date_filters(year=None, month=None, day=None):
+    """
+    Returns ``pub_date`` lookup arguments selecting the year, month
+    (given as a lowercase abbreviation, as in coltrane's URLs) or day
+    given, or an empty dictionary if they don't form a valid date.
+    
+    """
+    if year is None:
+        return {}
+    try:
+        if month is None:
+            return { 'pub_date__year': int(year) }
+        date = datetime.date(*time.strptime('%s-%s-%s' % (year, month, day or '01'), '%Y-%b-%d')[:3])
+    except ValueError:
+        return {}
+    if day is None:
+        return { 'pub_date__year': date.year, 'pub_date__month': date.month }
+    return { 'pub_date__range': (datetime.datetime.combine(date, datetime.time.min),
+                                 datetime.datetime.combine(date, datetime.time.max)) }
+
+def note_removal(sender=None, instance=None, **kwargs):
+    """
+    Records that an Entry has just left a page listing it, and
+    returns the time recorded.
+    
+    """
+    now = datetime.datetime.now()
+    cache.set(REMOVAL_KEY, now, GENERATION_TIMEOUT)
+    return now
+
+def last_removal():
+    """
+    Returns the time an Entry last left a page listing it. If the
+    time has dropped out of the cache, it's taken to be now.
+    
+    """
+    removed = cache.get(REMOVAL_KEY)
+    if removed is None:
+        removed = note_removal()
+    return removed
+
+def note_deleted_entry(sender, instance, **kwargs):
+    """
+    Signal handler which records a removal when a live Entry is
+    deleted.
+    
+    """
+    original = getattr(instance, '_original_state', None)
+    if original is not None and original['status'] == instance.LIVE_STATUS:
+        note_removal()
+
+def note_moved_entry(sender, instance, **kwargs):
+    """
+    Signal handler which records a removal when a live Entry's date,
+    categories or tags change, since it leaves the pages for the old
+    ones. It's called through ``coltrane.deferred``, after the admin
+    has written the categories.
+    
+    """
+    from coltrane.counters import entry_tag_ids
+    original = getattr(instance, '_original_state', None)
+    if original is None or original['status'] != instance.LIVE_STATUS:
+        return
+    if original['pub_date'] != instance.pub_date or \
+       original['categories'] != set(instance.categories.values_list('id', flat=True)) or \
+       original['tags'] != entry_tag_ids(instance):
+        note_removal()
+
+def queryset_validators(scope, *parts):
+    """
+    Returns a ``(last_modified, etag)`` pair for a page listing the
+    live Entries in ``scope``, a ``QuerySet`` of Entries of any
+    status: the latest modification time among them (including
+    those which have stopped being live since, so that the time
+    never goes backwards), of any removal, or of publication of a
+    live Entry, and a tag covering that time, the number of live
+    Entries published so far and any further ``parts``. Entries
+    scheduled for the future are left out until their ``pub_date``,
+    when they first appear on the page.
+
+    Without a shared cache backend removals can't be tracked, so the
+    ``Last-Modified`` time is ``None``; the number of live Entries in
+    the tag still changes when one leaves.
+    
+    """
+    from coltrane.models import Entry
+    dates = list(scope.order_by('-last_modified').values_list('last_modified', flat=True)[:1])
+    published = scope.filter(status__exact=Entry.LIVE_STATUS, pub_date__lte=datetime.datetime.now())
+    count = published.count()
+    if not is_shared():
+        return None, make_etag(dates and dates[0] or None, count, *parts)
+    dates.extend(published.order_by('-pub_date').values_list('pub_date', flat=True)[:1])
+    last_modified = max(dates + [last_removal()])
+    return last_modified, make_etag(last_modified, count, *parts)
+
+def archive_validators(request, year=None, month=None, day=None, **kwargs):
+    """
+    Validators for the entry archive views.
+    
+    """
+    from coltrane.models import Entry
+    return queryset_validators(Entry.objects.filter(**date_filters(year, month, day)), request.get_full_path())
+
+def category_validators(request, slug, year=None, month=None, day=None, **kwargs):
+    """
+    Validators for the category views. Besides the Entries, they
+    cover the current Category generation, which changes whenever a
+    Category is edited, or without a shared cache backend the
+    Category's own title and description.
+    
+    """
+    from coltrane.caching import category_generation
+    from coltrane.models import Category, Entry
+    scope = Entry.objects.filter(categories__slug__exact=slug, **date_filters(year, month, day))
+    if not is_shared():
+        return queryset_validators(scope, list(Category.objects.filter(slug__exact=slug).values_list('title', 'description_html')),
+                                   request.get_full_path())
+    generation = category_generation()
+    last_modified, etag = queryset_validators(scope, generation, request.get_full_path())
+    return max(last_modified, datetime.datetime.fromtimestamp(float(generation))), etag
+
+def entry_validators(request, year, month, day, slug, **kwargs):
+    """
+    Validators for the entry detail view. Besides the Entry itself,
+    they cover its comment count, and the current Entry generation
+    (since its neighbors are linked from the page), or without a
+    shared cache backend the latest modification time and number of
+    all live Entries.
+    
+    """
+    from coltrane.caching import entry_generation
+    from coltrane.models import Entry
+    rows = list(Entry.live.filter(slug__exact=slug, **date_filters(year, month, day)).values_list('last_modified', 'comment_count')[:1])
+    if not rows:
+        return None, None
+    last_modified, comment_count = rows[0]
+    if is_shared():
+        generation = entry_generation()
+    else:
+        generation = queryset_validators(Entry.objects.all())[1]
+    return last_modified, make_etag(last_modified, comment_count, generation, request.get_full_path())
+
+def condition(validators):
+    """
+    Returns a decorator for a view, which answers conditional GET and
+    HEAD requests with a 304 response when the client's copy is
+    current, without calling the view. Otherwise the view's
+    successful responses get ``Last-Modified``, ``ETag`` and
+    ``Cache-Control`` headers; the ``COLTRANE_CACHE_MAX_AGE`` setting
+    (default 0) controls how long clients and caches may use a
+    response before revalidating it.
+
+    ``validators`` is called with the view's arguments and returns a
+    ``(last_modified, etag)`` pair.
+    
+    """
+    def decorator(view):
+        def wrapped(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            last_modified, etag = validators(request, *args, **kwargs)
+            if is_not_modified(request, last_modified, etag):
+                return not_modified_response(last_modified, etag)
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                set_validators(response, last_modified, etag)
+                patch_cache_control(response,
+                                    max_age=getattr(settings, 'COLTRANE_CACHE_MAX_AGE', 0),
+                                    must_revalidate=True)
+            return response
+        wrapped.__doc__ = view.__doc__
+        return wrapped
+    return decorator
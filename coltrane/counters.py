@@ -0,0 +1,136 @@
+"""
+Maintained counts of live Entries per Category and per tag.
+
+Each Category's ``live_entry_count``, and the ``TagCount`` row for
+each tag, are recounted whenever an Entry is saved or deleted in a
+way which could change them: a change of status, or of its
+categories or tags while it's live. Lists of Categories and tag
+clouds can then be read with a single query, instead of counting
+Entries for every Category or tag they show. Use ``manage.py
+coltrane_rebuild counts`` to recount everything.
+
+"""
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+
+from coltrane.archive import _category_join_sql
+from coltrane.caching import bump_category_generation
+
+
+def entry_tag_ids(entry):
+    """
+    Returns the set of ids of the tags applied to ``entry``.
+    
+    """
+    from tagging.models import TaggedItem
+    from coltrane.models import Entry
+    ctype = ContentType.objects.get_for_model(Entry)
+    return set(TaggedItem.objects.filter(content_type__pk=ctype.id,
+                                         object_id=entry.id).values_list('tag', flat=True))
+
+def _category_counts(category_ids=None):
+    from coltrane.models import Entry
+    category_column, date_column, from_where = _category_join_sql()
+    sql = "SELECT %s, COUNT(*) %s" % (category_column, from_where)
+    params = [Entry.LIVE_STATUS]
+    if category_ids is not None:
+        sql += " AND %s IN (%s)" % (category_column, ', '.join(['%s'] * len(category_ids)))
+        params.extend(category_ids)
+    cursor = connection.cursor()
+    cursor.execute(sql + " GROUP BY %s" % category_column, params)
+    return dict(cursor.fetchall())
+
+def _tag_counts(tag_ids=None):
+    from tagging.models import TaggedItem
+    from coltrane.models import Entry
+    qn = connection.ops.quote_name
+    tag_table, entry_table = qn(TaggedItem._meta.db_table), qn(Entry._meta.db_table)
+    tag_column = '%s.%s' % (tag_table, qn('tag_id'))
+    sql = "SELECT %s, COUNT(*) FROM %s INNER JOIN %s ON %s.%s = %s.%s WHERE %s.%s = %%s AND %s.%s = %%s" % \
+          (tag_column, tag_table, entry_table,
+           entry_table, qn(Entry._meta.pk.column), tag_table, qn('object_id'),
+           tag_table, qn('content_type_id'), entry_table, qn('status'))
+    params = [ContentType.objects.get_for_model(Entry).id, Entry.LIVE_STATUS]
+    if tag_ids is not None:
+        sql += " AND %s IN (%s)" % (tag_column, ', '.join(['%s'] * len(tag_ids)))
+        params.extend(tag_ids)
+    cursor = connection.cursor()
+    cursor.execute(sql + " GROUP BY %s" % tag_column, params)
+    return dict(cursor.fetchall())
+
+def refresh_counts(category_ids, tag_ids):
+    """
+    Recounts the live Entries in each of the Categories and tags
+    whose ids are given.
+    
+    """
+    from coltrane.models import Category, TagCount
+    category_ids, tag_ids = list(category_ids), list(tag_ids)
+    if category_ids:
+        counts = _category_counts(category_ids)
+        for category_id in category_ids:
+            Category.objects.filter(pk=category_id).update(live_entry_count=counts.get(category_id, 0))
+        bump_category_generation()
+    if tag_ids:
+        counts = _tag_counts(tag_ids)
+        TagCount.objects.filter(tag__id__in=tag_ids).delete()
+        for tag_id in tag_ids:
+            if counts.get(tag_id):
+                TagCount.objects.create(tag_id=tag_id, live_entry_count=counts[tag_id])
+    transaction.commit_unless_managed()
+
+def update_entry_counts(sender, instance, **kwargs):
+    """
+    Signal handler which recounts the Categories and tags an Entry
+    belongs to, or used to belong to, when it's saved.
+
+    It's called through ``coltrane.deferred``, so during a request it
+    sees the categories the admin writes after saving the Entry, and
+    compares them with those recorded before the save. Code outside a
+    request which changes an Entry's categories after saving it
+    should rebuild the counts.
+    
+    """
+    original = getattr(instance, '_original_state', None)
+    was_live = original is not None and original['status'] == instance.LIVE_STATUS
+    is_live = instance.status == instance.LIVE_STATUS
+    if not was_live and not is_live:
+        return
+    categories = set(instance.categories.values_list('id', flat=True))
+    tags = entry_tag_ids(instance)
+    if was_live and is_live:
+        # Only membership changes can alter the counts.
+        categories = categories ^ original['categories']
+        tags = tags ^ original['tags']
+    elif was_live:
+        categories = categories | original['categories']
+        tags = tags | original['tags']
+    refresh_counts(categories, tags)
+
+def remove_entry_counts(sender, instance, **kwargs):
+    """
+    Signal handler which recounts the Categories and tags a live
+    Entry belonged to when it's deleted.
+    
+    """
+    original = getattr(instance, '_original_state', None)
+    if original is None or original['status'] != instance.LIVE_STATUS:
+        return
+    refresh_counts(original['categories'], original['tags'])
+
+def rebuild_counts():
+    """
+    Recounts the live Entries in every Category and tag.
+    
+    """
+    from coltrane.models import Category, TagCount
+    counts = _category_counts()
+    Category.objects.update(live_entry_count=0)
+    for category_id, count in counts.items():
+        Category.objects.filter(pk=category_id).update(live_entry_count=count)
+    bump_category_generation()
+    TagCount.objects.all().delete()
+    for tag_id, count in _tag_counts().items():
+        TagCount.objects.create(tag_id=tag_id, live_entry_count=count)
+    transaction.commit_unless_managed()
@@ -0,0 +1,98 @@
+"""
+Signal handling for work which depends on an Entry's categories.
+
+Django's admin saves an Entry and only then writes its
+``categories``, so ordinary ``post_save`` handlers see the categories
+the Entry had before the edit. Handlers registered with ``connect``
+are instead called once the current request has finished, by which
+time the categories are in place; outside a request (in scripts and
+management commands) they're called straight away.
+
+Each handler is called like a ``post_save`` handler, at most once per
+Entry per request. If an Entry is saved more than once during a
+request, the handlers see the ``_original_state`` recorded before its
+first save, so that they compare against what was in the database
+before the request.
+
+"""
+
+import logging
+import sys
+import threading
+
+from django.core import signals as core_signals
+from django.dispatch import dispatcher
+
+
+_handlers = []
+
+# The Entries saved during the current thread's request, in the order
+# they were first saved, or None outside a request.
+_pending = threading.local()
+
+
+def connect(handler):
+    """
+    Has ``handler`` called for each saved Entry once its categories
+    have been written.
+    
+    """
+    if handler not in _handlers:
+        _handlers.append(handler)
+
+def in_request():
+    """
+    Returns ``True`` if the current thread is handling a request.
+    
+    """
+    return getattr(_pending, 'entries', None) is not None
+
+def _run(instance):
+    for handler in _handlers:
+        handler(sender=instance.__class__, instance=instance)
+
+def entry_saved(sender, instance, **kwargs):
+    """
+    Signal handler which calls the registered handlers for a saved
+    Entry, after the current request if there is one.
+    
+    """
+    entries = getattr(_pending, 'entries', None)
+    if entries is None:
+        _run(instance)
+        return
+    for i, (entry_id, earlier) in enumerate(entries):
+        if entry_id == instance.id:
+            instance._original_state = getattr(earlier, '_original_state', None)
+            entries[i] = (entry_id, instance)
+            return
+    entries.append((instance.id, instance))
+
+def entry_deleted(sender, instance, **kwargs):
+    """
+    Signal handler which drops a deleted Entry from the Entries
+    waiting for their handlers; the delete handlers have already
+    brought everything up to date.
+    
+    """
+    entries = getattr(_pending, 'entries', None)
+    if entries:
+        _pending.entries = [(entry_id, entry) for entry_id, entry in entries if entry_id != instance.id]
+
+def _request_started(**kwargs):
+    _pending.entries = []
+
+def _request_finished(**kwargs):
+    entries = getattr(_pending, 'entries', None) or []
+    _pending.entries = None
+    for entry_id, instance in entries:
+        # The response has already been sent, so a failure can only
+        # be logged; coltrane_rebuild repairs what it leaves behind.
+        try:
+            _run(instance)
+        except Exception:
+            logging.getLogger('coltrane').error('Updating %r after the request failed: %s' % \
+                                                (instance, sys.exc_info()[1]))
+
+dispatcher.connect(_request_started, signal=core_signals.request_started)
+dispatcher.connect(_request_finished, signal=core_signals.request_finished)
@@ -0,0 +1,181 @@
+"""
+Syndication feeds of live entries: the latest entries overall, in a
+given Category, or with a given tag.
+
+Feeds are served by the ``feed`` view in this module, which answers
+conditional GETs with a 304 response before building the feed, and
+reads items with a chunked iterator rather than loading them all at
+once. Wire it up with ``coltrane.urls.feeds``::
+
+    (r'^feeds/', include('coltrane.urls.feeds')),
+
+which serves ``feeds/entries/``, ``feeds/categories/<slug>/`` and
+``feeds/tags/<tag>/``. The number of items in each feed is set by the
+``COLTRANE_FEED_ITEMS`` setting (default 15).
+
+"""
+
+import datetime
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.contrib.syndication.feeds import Feed, FeedDoesNotExist
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse
+from tagging.models import Tag, TaggedItem
+
+from coltrane.caching import get_category
+from coltrane.conditional import is_not_modified, not_modified_response, queryset_validators, set_validators
+from coltrane.models import Entry
+
+
+class LiveEntriesFeed(Feed):
+    """
+    Base class for feeds of live entries.
+
+    Subclasses implement ``get_queryset(obj)``, returning the
+    ``QuerySet`` of live entries the feed covers (leaving out those
+    scheduled for the future), and
+    ``get_scope(obj)``, returning the Entries of any status it would
+    cover if they were live.
+    
+    """
+    def __init__(self, slug, feed_url):
+        super(LiveEntriesFeed, self).__init__(slug, feed_url)
+        self._objects = {}
+
+    def get_object(self, bits):
+        # The feed view needs the object before building the feed,
+        # and building it looks it up again; remember it.
+        key = tuple(bits)
+        if key not in self._objects:
+            self._objects[key] = self.lookup_object(bits)
+        return self._objects[key]
+
+    def lookup_object(self, bits):
+        if bits:
+            raise ObjectDoesNotExist
+        return None
+
+    def get_queryset(self, obj):
+        raise NotImplementedError
+
+    def get_scope(self, obj):
+        raise NotImplementedError
+
+    def items(self, obj):
+        return self.get_queryset(obj).order_by('-pub_date')[:getattr(settings, 'COLTRANE_FEED_ITEMS', 15)].iterator()
+
+    def item_pubdate(self, item):
+        return item.pub_date
+
+    def validators(self, obj, feed_url):
+        """
+        Returns the ``Last-Modified`` time and ``ETag`` of the feed,
+        from the latest modification time and number of the entries
+        it covers; see ``coltrane.conditional.queryset_validators``.
+        
+        """
+        return queryset_validators(self.get_scope(obj), feed_url)
+
+    def _site_name(self):
+        return Site.objects.get_current().name
+
+
+class LatestEntriesFeed(LiveEntriesFeed):
+    def title(self):
+        return u'%s: latest entries' % self._site_name()
+
+    def description(self):
+        return self.title()
+
+    def link(self):
+        return reverse('coltrane_entry_archive_index')
+
+    def get_queryset(self, obj):
+        return Entry.live.filter(pub_date__lte=datetime.datetime.now())
+
+    def get_scope(self, obj):
+        return Entry.objects.all()
+
+
+class CategoryFeed(LiveEntriesFeed):
+    def lookup_object(self, bits):
+        if len(bits) != 1:
+            raise ObjectDoesNotExist
+        return get_category(bits[0])
+
+    def title(self, obj):
+        return u'%s: latest entries in %s' % (self._site_name(), obj.title)
+
+    def description(self, obj):
+        return obj.description
+
+    def link(self, obj):
+        return obj.get_absolute_url()
+
+    def get_queryset(self, obj):
+        return obj.live_entry_set.filter(pub_date__lte=datetime.datetime.now())
+
+    def get_scope(self, obj):
+        return obj.entry_set.all()
+
+
+class TagFeed(LiveEntriesFeed):
+    def lookup_object(self, bits):
+        if len(bits) != 1:
+            raise ObjectDoesNotExist
+        return Tag.objects.get(name=bits[0])
+
+    def title(self, obj):
+        return u'%s: latest entries tagged %s' % (self._site_name(), obj.name)
+
+    def description(self, obj):
+        return self.title(obj)
+
+    def link(self):
+        return reverse('coltrane_entry_archive_index')
+
+    def get_queryset(self, obj):
+        return TaggedItem.objects.get_by_model(Entry.live.filter(pub_date__lte=datetime.datetime.now()), obj)
+
+    def get_scope(self, obj):
+        return TaggedItem.objects.get_by_model(Entry.objects.all(), obj)
+
+
+FEEDS = {
+    'entries': LatestEntriesFeed,
+    'categories': CategoryFeed,
+    'tags': TagFeed,
+    }
+
+
+def feed(request, url, feed_dict=FEEDS):
+    """
+    Serves the feed named by the first part of ``url`` from
+    ``feed_dict``; the rest of ``url`` identifies the Category or tag
+    for feeds which need one.
+
+    This works like ``django.contrib.syndication.views.feed``, but
+    sends ``Last-Modified`` and ``ETag`` headers computed from the
+    entries in the feed, and returns a 304 response without
+    building the feed when the client's copy is current.
+    
+    """
+    bits = url.split('/')
+    try:
+        f = feed_dict[bits[0]](bits[0], request.path)
+        obj = f.get_object(bits[1:])
+    except (KeyError, ObjectDoesNotExist):
+        raise Http404("No feed for %r" % url)
+    last_modified, etag = f.validators(obj, request.path)
+    if is_not_modified(request, last_modified, etag):
+        return not_modified_response(last_modified, etag)
+    try:
+        feedgen = f.get_feed('/'.join(bits[1:]))
+    except FeedDoesNotExist:
+        raise Http404("No feed for %r" % url)
+    response = HttpResponse(mimetype=feedgen.mime_type)
+    feedgen.write(response, 'utf-8')
+    return set_validators(response, last_modified, etag)
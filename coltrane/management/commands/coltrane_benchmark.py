@@ -0,0 +1,61 @@
+"""
+Management command which runs coltrane's benchmark suite against a
+freshly seeded test database.
+
+"""
+
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--entries', dest='entries', default=500, type='int',
+                    help='Number of Entries to seed.'),
+        make_option('--categories', dest='categories', default=10, type='int',
+                    help='Number of Categories to seed.'),
+        make_option('--tags', dest='tags', default=100, type='int',
+                    help='Number of distinct tags to seed.'),
+        make_option('--comments', dest='comments', default=2000, type='int',
+                    help='Number of comments to seed.'),
+        make_option('--repeat', dest='repeat', default=20, type='int',
+                    help='Number of times to run each benchmark.'),
+        )
+    help = "Seeds a synthetic weblog into a test database, times coltrane's views and featured-entry tags, and fails if any goes over its query budget."
+
+    def handle(self, *args, **options):
+        from django.test.utils import create_test_db, destroy_test_db
+        from coltrane import benchmarks
+        verbosity = int(options.get('verbosity', 1))
+        repeat = options.get('repeat', 20)
+        old_name = settings.DATABASE_NAME
+        # Queries are only recorded with DEBUG on.
+        old_debug, settings.DEBUG = settings.DEBUG, True
+        create_test_db(verbosity=0, autoclobber=True)
+        try:
+            if verbosity:
+                sys.stdout.write('Seeding %s entries, %s categories, %s tags and %s comments\n' % \
+                                 (options.get('entries'), options.get('categories'),
+                                  options.get('tags'), options.get('comments')))
+            benchmarks.seed_blog(options.get('entries', 500), options.get('categories', 10),
+                                 options.get('tags', 100), options.get('comments', 2000))
+            timings = benchmarks.benchmark_urls(repeat) + benchmarks.benchmark_template_tags(repeat)
+        finally:
+            destroy_test_db(old_name, verbosity=0)
+            settings.DEBUG = old_debug
+
+        sys.stdout.write('%-50s %8s %8s %8s %8s %8s\n' % ('', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'queries'))
+        for timing in timings:
+            sys.stdout.write('%-50s %8.1f %8.1f %8.1f %8.1f %8s\n' % \
+                             (timing.name,
+                              timing.percentile(50) * 1000, timing.percentile(90) * 1000,
+                              timing.percentile(99) * 1000, max(timing.latencies) * 1000,
+                              '%s-%s' % (min(timing.queries), timing.max_queries())))
+        over = benchmarks.check_budgets(timings)
+        for timing, budget in over:
+            sys.stderr.write('%s made %s queries, over its budget of %s\n' % (timing.name, timing.max_queries(), budget))
+        if over:
+            raise CommandError('%d benchmarks went over their query budgets' % len(over))
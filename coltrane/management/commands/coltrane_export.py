@@ -0,0 +1,267 @@
+"""
+Management command which exports the weblog's entry, archive and
+category pages as static files, for serving directly from a web
+server.
+
+Entries scheduled for the future, and the archives which would only
+list them, are left out until an export after their ``pub_date``.
+
+The manifest records the ``coltrane.pagecache`` tags each page
+depended on when it was rendered. After the first export, only the
+pages depending on the tags which Entries modified since (including
+those which gained or lost comments, or whose ``pub_date`` has
+passed) would have purged are rendered again, so that the archive
+navigation, category list, tag cloud, featured entries and related
+entries shown around the main content are kept current too. Pages
+show Category titles all over the site, so a changed Category has
+every page rendered again.
+
+"""
+
+import datetime
+import os
+import sys
+import time
+from itertools import imap
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.utils import simplejson
+from django.utils.encoding import smart_str
+from optparse import make_option
+
+from coltrane import pagecache
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+
+MANIFEST_NAME = '.coltrane-export.json'
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_client = None
+
+
+def render_page(path):
+    """
+    Renders the page at ``path`` through the test client, returning a
+    ``(path, status_code, content, tags)`` tuple, where ``tags`` is a
+    list of the page cache tags the page depends on.
+
+    This takes and returns picklable values, for use with
+    ``multiprocessing`` pools; each process makes its own client.
+    
+    """
+    global _client
+    if _client is None:
+        from django.test.client import Client
+        _client = Client()
+    pagecache.start_collecting()
+    try:
+        response = _client.get(path)
+    finally:
+        tags = pagecache.stop_collecting()
+    return path, response.status_code, response.content, list(tags)
+
+def _date_kwargs(date):
+    return { 'year': date.strftime('%Y'),
+             'month': date.strftime('%b').lower(),
+             'day': date.strftime('%d') }
+
+def date_paths(date):
+    """
+    Returns the paths of the day, month and year archives containing
+    ``date``.
+    
+    """
+    kwargs = _date_kwargs(date)
+    return [reverse('coltrane_entry_archive_day', kwargs=kwargs),
+            reverse('coltrane_entry_archive_month', kwargs={ 'year': kwargs['year'], 'month': kwargs['month'] }),
+            reverse('coltrane_entry_archive_year', kwargs={ 'year': kwargs['year'] })]
+
+def entry_path(pub_date, slug):
+    kwargs = _date_kwargs(pub_date)
+    kwargs['slug'] = slug
+    return reverse('coltrane_entry_detail', kwargs=kwargs)
+
+def _parse_timestamp(value):
+    return datetime.datetime(*time.strptime(value, TIMESTAMP_FORMAT)[:6])
+
+def site_state(now):
+    """
+    Returns the set of every page path to export, a dictionary
+    describing each live Entry published by ``now`` (its path,
+    publication date, slug, categories, tags, whether it's featured
+    and its related entries) keyed by id, and a dictionary of a hash
+    of each Category's title and description keyed by slug, for
+    recording in the manifest.
+    
+    """
+    from coltrane.models import Category, Entry, RelatedEntry
+    paths = set([reverse('coltrane_entry_archive_index'), reverse('coltrane_category_list')])
+    categories = {}
+    for slug, title, description_html in Category.objects.values_list('slug', 'title', 'description_html'):
+        paths.add(reverse('coltrane_category_detail', kwargs={ 'slug': slug }))
+        categories[slug] = md5(smart_str(u'%s|%s' % (title, description_html or u''))).hexdigest()
+    related = {}
+    for entry_id, related_id in RelatedEntry.objects.values_list('entry', 'related'):
+        related.setdefault(entry_id, []).append(related_id)
+    entries = {}
+    for entry in Entry.live.filter(pub_date__lte=now).summary().with_categorization().iterator():
+        path = entry_path(entry.pub_date, entry.slug)
+        paths.add(path)
+        paths.update(date_paths(entry.pub_date))
+        entries[str(entry.id)] = { 'path': path,
+                                   'pub_date': entry.pub_date.strftime(TIMESTAMP_FORMAT),
+                                   'slug': entry.slug,
+                                   'categories': [category.slug for category in entry.get_categories()],
+                                   'tags': [tag.id for tag in entry.get_tags()],
+                                   'featured': entry.featured,
+                                   'related': related.get(entry.id, []) }
+    return paths, entries, categories
+
+def _placement(state):
+    return state['pub_date'], sorted(state['categories']), sorted(state['tags'])
+
+def affected_tags(since, entries, previous_entries):
+    """
+    Returns the set of page cache tags which the changes to Entries
+    since the last export would have purged: those of Entries
+    modified after ``since``, live at the last export but not now, or
+    the other way round. For each such Entry's current state and its
+    state at the last export, that's its detail page, those of its
+    live neighbors and the listings it's in, and the archive
+    navigation, category list and tag cloud if it joined or left a
+    date, Category or tag; as well as the related entries of every
+    Entry whose list changed or includes a changed Entry.
+    
+    """
+    from coltrane.models import Entry
+    changed = set([str(entry_id) for entry_id in Entry.objects.filter(last_modified__gt=since).values_list('id', flat=True)])
+    changed.update(set(previous_entries.keys()) ^ set(entries.keys()))
+    tags = set()
+    for entry_id in changed:
+        states = [state for state in (entries.get(entry_id), previous_entries.get(entry_id)) if state is not None]
+        for state in states:
+            pub_date = _parse_timestamp(state['pub_date'])
+            tags.update(pagecache.entry_page_tags(pub_date, state['slug'], state['categories'], state['featured']))
+            tags.update(pagecache.neighbor_tags(pub_date, int(entry_id)))
+        if len(states) != 2 or _placement(states[0]) != _placement(states[1]):
+            tags.update(['archive', 'categories', 'tags'])
+    for entry_id in set(entries.keys()) | set(previous_entries.keys()):
+        current = entries.get(entry_id, {}).get('related', [])
+        previous = previous_entries.get(entry_id, {}).get('related', [])
+        if current != previous or changed & set([str(related_id) for related_id in current + previous]):
+            tags.add(u'related:%s' % entry_id)
+    return tags
+
+def _file_name(output_dir, path):
+    return os.path.join(output_dir, *(path.strip('/').split('/') + ['index.html']))
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', dest='processes', default=None, type='int',
+                    help='Number of worker processes to render with. Defaults to the number of CPUs.'),
+        make_option('--full', action='store_true', dest='full', default=False,
+                    help='Render every page, rather than only those affected by Entries changed since the last export.'),
+        )
+    help = 'Exports the entry, archive and category pages to static files in the given directory.'
+    args = '<output_dir>'
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the directory to export to.')
+        output_dir = args[0]
+        verbosity = int(options.get('verbosity', 1))
+        manifest_file = os.path.join(output_dir, MANIFEST_NAME)
+        manifest = { 'exported_at': None, 'pages': {}, 'entries': {} }
+        if os.path.exists(manifest_file):
+            manifest = simplejson.loads(open(manifest_file).read())
+        started = datetime.datetime.now()
+
+        paths, entries, categories = site_state(started)
+        pages = manifest['pages']
+        # Manifests written before page tags were recorded can't tell
+        # which pages to render again.
+        page_tags = manifest.get('page_tags')
+        if options.get('full') or manifest['exported_at'] is None or page_tags is None or \
+           manifest.get('categories') != categories:
+            page_tags = {}
+            todo = paths
+        else:
+            purged = affected_tags(_parse_timestamp(manifest['exported_at']), entries, manifest['entries'])
+            todo = set([path for path in paths if path not in page_tags or purged.intersection(page_tags[path])])
+
+        removed = 0
+        for path in set(pages.keys()) - paths:
+            file_name = _file_name(output_dir, path)
+            if os.path.exists(file_name):
+                os.remove(file_name)
+            del pages[path]
+            page_tags.pop(path, None)
+            removed += 1
+
+        # Worker processes mustn't share the parent's database connection.
+        connection.close()
+        if multiprocessing is not None and options.get('processes') != 1 and len(todo) > 1:
+            pool = multiprocessing.Pool(options.get('processes'))
+            results = pool.imap_unordered(render_page, todo, 16)
+        else:
+            pool = None
+            results = imap(render_page, todo)
+        written = unchanged = 0
+        failed = []
+        try:
+            for path, status_code, content, tags in results:
+                if status_code != 200:
+                    failed.append((path, status_code))
+                    continue
+                page_tags[path] = tags
+                digest = md5(content).hexdigest()
+                file_name = _file_name(output_dir, path)
+                if pages.get(path) == digest and os.path.exists(file_name):
+                    unchanged += 1
+                    continue
+                if not os.path.isdir(os.path.dirname(file_name)):
+                    os.makedirs(os.path.dirname(file_name))
+                out = open(file_name, 'wb')
+                try:
+                    out.write(content)
+                finally:
+                    out.close()
+                pages[path] = digest
+                written += 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        manifest = { 'exported_at': started.strftime(TIMESTAMP_FORMAT),
+                     'pages': pages,
+                     'page_tags': page_tags,
+                     'entries': entries,
+                     'categories': categories }
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        out = open(manifest_file, 'w')
+        try:
+            out.write(simplejson.dumps(manifest))
+        finally:
+            out.close()
+        if verbosity:
+            sys.stdout.write('%d pages rendered: %d written, %d unchanged; %d removed\n' % \
+                             (len(todo), written, unchanged, removed))
+        for path, status_code in failed:
+            sys.stderr.write('%s: status %s, not exported\n' % (path, status_code))
+        if failed:
+            raise CommandError('%d pages could not be exported' % len(failed))
@@ -0,0 +1,303 @@
+"""
+Management command which imports entries, with their categories and
+tags, from a JSON Lines file or a WordPress export (WXR) file.
+
+The file is read incrementally and written in batches, each in its
+own transaction, without calling ``save()``: entries and new
+categories are inserted with ``render_pending`` set, and their HTML
+is rendered afterwards by ``coltrane_rerender`` across several
+processes. Everything the save signal handlers would have maintained
+is then rebuilt with ``coltrane_rebuild``.
+
+Each line of a JSON Lines file is an object with a ``title``,
+``body`` and ``pub_date`` ('YYYY-MM-DD HH:MM:SS'), and optionally a
+``slug``, ``excerpt``, ``status`` (a key of ``STATUSES``),
+``featured``, ``enable_comments``, ``categories`` (a list of
+``[slug, title]`` pairs) and ``tags`` (a list of names).
+
+Importing the same file twice imports its entries twice.
+
+"""
+
+import datetime
+import sys
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.template.defaultfilters import slugify
+from django.utils import simplejson
+from optparse import make_option
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Entry statuses for the status names of JSON Lines and WordPress
+# files; scheduled WordPress posts are live, and only show once their
+# date has passed.
+STATUSES = { 'live': 1, 'publish': 1, 'future': 1,
+             'draft': 2, 'pending': 2,
+             'hidden': 3, 'private': 3 }
+
+# WordPress statuses of items which aren't really posts (deleted
+# posts, unsaved drafts and revisions), which are skipped.
+SKIPPED_STATUSES = ('trash', 'auto-draft', 'inherit')
+
+
+def _parse_date(value):
+    return datetime.datetime(*time.strptime(value.strip(), DATE_FORMAT)[:6])
+
+def read_jsonl(stream):
+    """
+    Yields an entry dictionary for each line of a JSON Lines stream.
+    
+    """
+    for line in stream:
+        if line.strip():
+            yield simplejson.loads(line)
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def read_wxr(stream):
+    """
+    Yields an entry dictionary for each post in a WordPress export
+    stream, clearing each parsed item from the tree so that memory
+    use doesn't grow with the size of the file.
+    
+    """
+    container = None
+    for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            if container is None or element.tag == 'channel':
+                container = element
+            continue
+        if element.tag != 'item':
+            continue
+        entry = { 'categories': [], 'tags': [] }
+        post_type = 'post'
+        for child in element:
+            name, text = _local_name(child.tag), child.text or u''
+            if child.tag == 'title':
+                entry['title'] = text
+            elif name == 'encoded' and 'excerpt' in child.tag:
+                entry['excerpt'] = text
+            elif name == 'encoded':
+                entry['body'] = text
+            elif name == 'post_date':
+                entry['pub_date'] = text
+            elif name == 'post_name':
+                entry['slug'] = text
+            elif name == 'status':
+                entry['status'] = text
+            elif name == 'post_type':
+                post_type = text
+            elif name == 'comment_status':
+                entry['enable_comments'] = text == 'open'
+            elif child.tag == 'category' and child.get('domain') == 'category' and child.get('nicename'):
+                entry['categories'].append([child.get('nicename'), text])
+            elif child.tag == 'category' and child.get('domain') in ('tag', 'post_tag'):
+                entry['tags'].append(text)
+        # Drop the parsed items from the channel they were built in.
+        container.clear()
+        if post_type == 'post':
+            yield entry
+
+
+class Importer(object):
+    """
+    Writes entries to the database a batch at a time, along with the
+    Categories and tags they use which don't exist yet.
+
+    Entry, Category and tag ids are assigned here, counting up from
+    the highest existing ids, so that all the rows of a batch can be
+    written at once; don't add entries, Categories or tags some other
+    way while an import is running.
+    
+    """
+    def __init__(self, author):
+        from tagging.models import Tag
+        from coltrane.models import Category, Entry
+        self.author = author
+        self.ctype = ContentType.objects.get_for_model(Entry)
+        self.categories = dict(Category.objects.values_list('slug', 'id'))
+        self.tags = dict(Tag.objects.values_list('name', 'id'))
+        self.next_id = self._next_id(Entry)
+        self.next_category_id = self._next_id(Category)
+        self.next_tag_id = self._next_id(Tag)
+        self.new_categories, self.new_tags = [], []
+        self.imported = 0
+        self.skipped = 0
+
+    def _next_id(self, model):
+        ids = list(model.objects.order_by('-id').values_list('id', flat=True)[:1])
+        return (ids and ids[0] or 0) + 1
+
+    def category_id(self, slug, title):
+        from coltrane.models import Category
+        if slug not in self.categories:
+            self.categories[slug] = self.next_category_id
+            self.next_category_id += 1
+            self.new_categories.append(Category(id=self.categories[slug], slug=slug,
+                                                title=title or slug, description=title or slug,
+                                                render_pending=True))
+        return self.categories[slug]
+
+    def tag_name(self, name):
+        if getattr(settings, 'FORCE_LOWERCASE_TAGS', False):
+            return name.lower()
+        return name
+
+    def tag_id(self, name):
+        from tagging.models import Tag
+        if name not in self.tags:
+            self.tags[name] = self.next_tag_id
+            self.next_tag_id += 1
+            self.new_tags.append(Tag(id=self.tags[name], name=name))
+        return self.tags[name]
+
+    def write(self, batch):
+        """
+        Inserts a batch of entry dictionaries, with their category
+        and tag rows and the Categories and tags first seen in the
+        batch, and commits. Raises ``CommandError`` for an entry with
+        an unknown status.
+        
+        """
+        from tagging.models import Tag, TaggedItem
+        from tagging.utils import edit_string_for_tags
+        from coltrane.bulk import bulk_insert, bulk_insert_rows
+        from coltrane.models import Category, Entry
+        entries, category_rows, tag_rows = [], [], []
+        for data in batch:
+            status = data.get('status', 'live')
+            if status in SKIPPED_STATUSES:
+                self.skipped += 1
+                continue
+            if status not in STATUSES:
+                raise CommandError("Unknown status '%s' for entry '%s'; expected one of %s" % \
+                                   (status, data.get('title'), ', '.join(sorted(STATUSES.keys()))))
+            entry_id = self.next_id
+            self.next_id += 1
+            tags = []
+            for name in data.get('tags') or []:
+                name = self.tag_name(name)
+                if name not in [tag.name for tag in tags]:
+                    tags.append(Tag(name=name))
+                    tag_rows.append((self.tag_id(name), self.ctype.id, entry_id))
+            category_ids = []
+            for slug, title in data.get('categories') or []:
+                category_id = self.category_id(slug, title)
+                if category_id not in category_ids:
+                    category_ids.append(category_id)
+                    category_rows.append((entry_id, category_id))
+            entries.append(Entry(id=entry_id, author=self.author,
+                                 title=data['title'],
+                                 slug=data.get('slug') or slugify(data['title']),
+                                 pub_date=_parse_date(data['pub_date']),
+                                 status=STATUSES[status],
+                                 featured=bool(data.get('featured', False)),
+                                 enable_comments=bool(data.get('enable_comments', True)),
+                                 body=data.get('body') or u'',
+                                 excerpt=data.get('excerpt') or u'',
+                                 tags=edit_string_for_tags(tags),
+                                 render_pending=True))
+        bulk_insert(Category, self.new_categories)
+        bulk_insert(Tag, self.new_tags)
+        self.new_categories, self.new_tags = [], []
+        bulk_insert(Entry, entries)
+        field = Entry._meta.get_field('categories')
+        bulk_insert_rows(field.m2m_db_table(), (field.m2m_column_name(), field.m2m_reverse_name()), category_rows)
+        bulk_insert_rows(TaggedItem._meta.db_table, ('tag_id', 'content_type_id', 'object_id'), tag_rows)
+        transaction.commit()
+        self.imported += len(entries)
+
+    def reset_sequences(self):
+        from tagging.models import Tag
+        from coltrane.models import Category, Entry
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Category, Entry, Tag]):
+            cursor.execute(sql)
+        transaction.commit()
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+                    help="Format of the file: 'jsonl' or 'wxr'. Defaults to a guess from the file name."),
+        make_option('--author', dest='author', default=None,
+                    help='Username of the author of the imported entries. Defaults to the first superuser.'),
+        make_option('--batch-size', dest='batch_size', default=500, type='int',
+                    help='Number of entries to write in each transaction.'),
+        make_option('--processes', dest='processes', default=None, type='int',
+                    help='Number of worker processes to render the imported entries with.'),
+        make_option('--no-rebuild', action='store_false', dest='rebuild', default=True,
+                    help="Don't render the entries or rebuild coltrane's denormalized data afterwards."),
+        )
+    help = 'Imports entries, categories and tags from a JSON Lines or WordPress export file.'
+    args = '<file>'
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the file to import.')
+        file_name = args[0]
+        format = options.get('format') or (file_name.endswith('.xml') and 'wxr' or 'jsonl')
+        readers = { 'jsonl': read_jsonl, 'wxr': read_wxr }
+        if format not in readers:
+            raise CommandError("Unknown format '%s'; choose from jsonl, wxr" % format)
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options.get('batch_size', 500)
+        try:
+            if options.get('author'):
+                author = User.objects.get(username=options['author'])
+            else:
+                author = User.objects.filter(is_superuser=True).order_by('id')[0]
+        except (User.DoesNotExist, IndexError):
+            raise CommandError('No author to import entries for; use --author.')
+
+        stream = open(file_name, format == 'wxr' and 'rb' or 'r')
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        importer = None
+        try:
+            try:
+                importer = Importer(author)
+                start = time.time()
+                batch = []
+                for data in readers[format](stream):
+                    batch.append(data)
+                    if len(batch) == batch_size:
+                        importer.write(batch)
+                        batch = []
+                        if verbosity:
+                            sys.stdout.write('%d entries imported (%.1f per second)\n' % \
+                                             (importer.imported, importer.imported / max(time.time() - start, 0.001)))
+                if batch:
+                    importer.write(batch)
+            except:
+                transaction.rollback()
+                raise
+        finally:
+            # Batches committed before a failure keep their explicitly
+            # assigned ids, so the sequence must move past them either way.
+            if importer is not None:
+                importer.reset_sequences()
+            transaction.leave_transaction_management()
+            stream.close()
+        if verbosity:
+            sys.stdout.write('%d entries imported in %.1fs, %d skipped\n' % \
+                             (importer.imported, time.time() - start, importer.skipped))
+
+        if options.get('rebuild', True):
+            call_command('coltrane_rerender', processes=options.get('processes'))
+            call_command('coltrane_rebuild', verbosity=verbosity)
@@ -0,0 +1,29 @@
+"""
+Management command which processes coltrane's comment moderation
+queue.
+
+"""
+
+import datetime
+import sys
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--retry-failed', action='store_true', dest='retry_failed', default=False,
+                    help='Give tasks which have run out of attempts another round of retries.'),
+        )
+    help = 'Runs the spam checks and notifications waiting in the comment moderation queue.'
+
+    def handle(self, *args, **options):
+        from coltrane.models import ModerationTask
+        from coltrane.moderation import process_queue
+        if options.get('retry_failed'):
+            ModerationTask.objects.filter(attempts__gt=0).update(attempts=0, next_attempt=datetime.datetime.now())
+        processed = process_queue()
+        if int(options.get('verbosity', 1)):
+            sys.stdout.write('%d moderation tasks processed; %d left in the queue\n' % \
+                             (processed, ModerationTask.objects.count()))
@@ -0,0 +1,65 @@
+"""
+Management command which shows the database's query plans, and
+timings, for the queries coltrane makes most often.
+
+Run it before and after installing the indexes in
+``coltrane/sql/entry.sql`` to see their effect.
+
+"""
+
+import datetime
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from optparse import make_option
+
+
+def sample_queries():
+    """
+    Returns a list of ``(description, QuerySet)`` pairs for the
+    queries made through ``LiveEntryManager``.
+    
+    """
+    from coltrane.models import Entry
+    queries = [
+        ('Latest live entries', Entry.live.all()[:15]),
+        ('Latest featured entries', Entry.live.featured()[:5]),
+        ]
+    try:
+        entry = Entry.live.all()[0]
+    except IndexError:
+        entry = None
+    if entry is not None:
+        day = entry.pub_date.date()
+        queries.append(('Entry detail lookup',
+                        Entry.live.filter(pub_date__range=(datetime.datetime.combine(day, datetime.time.min),
+                                                           datetime.datetime.combine(day, datetime.time.max)),
+                                          slug__exact=entry.slug)))
+    return queries
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', dest='repeat', default=100, type='int',
+                    help='Number of times to run each query when timing it.'),
+        )
+    help = 'Shows query plans and timings for the queries coltrane makes through LiveEntryManager.'
+
+    def handle(self, *args, **options):
+        repeat = options.get('repeat', 100)
+        explain = settings.DATABASE_ENGINE.startswith('sqlite') and 'EXPLAIN QUERY PLAN' or 'EXPLAIN'
+        cursor = connection.cursor()
+        for description, queryset in sample_queries():
+            sql, params = queryset.query.as_sql()
+            sys.stdout.write('%s\n%s\n' % (description, sql % tuple([repr(p) for p in params])))
+            cursor.execute('%s %s' % (explain, sql), params)
+            for row in cursor.fetchall():
+                sys.stdout.write('    %s\n' % ' | '.join([unicode(column) for column in row]))
+            start = time.time()
+            for i in range(repeat):
+                cursor.execute(sql, params)
+                cursor.fetchall()
+            sys.stdout.write('    %.3f ms per query\n\n' % ((time.time() - start) * 1000.0 / repeat))
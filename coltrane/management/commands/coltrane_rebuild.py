@@ -0,0 +1,66 @@
+"""
+Management command which rebuilds coltrane's denormalized data in
+bulk.
+
+"""
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from coltrane.pagecache import purge
+
+
+def rebuild_comments():
+    from coltrane.models import rebuild_comment_counts
+    rebuild_comment_counts()
+
+
+def rebuild_archive():
+    from coltrane.archive import rebuild_archive_index
+    rebuild_archive_index()
+
+
+def rebuild_search():
+    from coltrane.search import rebuild_search_index
+    rebuild_search_index()
+
+
+def rebuild_related():
+    from coltrane.related import rebuild_related_entries
+    rebuild_related_entries()
+
+
+def rebuild_counts():
+    from coltrane.counters import rebuild_counts
+    rebuild_counts()
+
+
+REBUILDERS = (
+    ('comments', rebuild_comments),
+    ('archive', rebuild_archive),
+    ('search', rebuild_search),
+    ('related', rebuild_related),
+    ('counts', rebuild_counts),
+    )
+
+
+class Command(BaseCommand):
+    help = "Rebuilds coltrane's denormalized data. With no arguments, everything is rebuilt; otherwise only the named targets (%s) are." % \
+           ', '.join([name for name, func in REBUILDERS])
+    args = '[target ...]'
+
+    def handle(self, *targets, **options):
+        verbosity = int(options.get('verbosity', 1))
+        known = [name for name, func in REBUILDERS]
+        for target in targets:
+            if target not in known:
+                raise CommandError("Unknown rebuild target '%s'; choose from %s" % (target, ', '.join(known)))
+        for name, func in REBUILDERS:
+            if targets and name not in targets:
+                continue
+            if verbosity:
+                sys.stdout.write("Rebuilding %s\n" % name)
+            func()
+        # Pages may show any of the rebuilt data.
+        purge('all')
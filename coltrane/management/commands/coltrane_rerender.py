@@ -0,0 +1,142 @@
+"""
+Management command which regenerates the HTML of every Entry and
+Category, for use after changing the markup filter settings.
+
+"""
+
+import datetime
+import sys
+import time
+from itertools import imap
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from optparse import make_option
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+
+def _stream_jobs(model, fields, after_id, chunk_size, force):
+    """
+    Yields a render job (see ``coltrane.rendering.render_sources``)
+    for each object of ``model`` with a primary key greater than
+    ``after_id``, reading them ``chunk_size`` at a time in primary key
+    order, and skipping those whose ``markup_hash`` shows they're
+    already rendered with the current settings unless ``force`` is
+    ``True``.
+    
+    ``fields`` is a sequence of ``(source_field, html_field,
+    optional)`` tuples; optional fields are only rendered when their
+    source text isn't empty, as in ``Entry.save``.
+    
+    """
+    from coltrane.rendering import source_hash
+    pk_name = model._meta.pk.name
+    source_fields = [source_field for source_field, html_field, optional in fields]
+    while True:
+        rows = list(model.objects.filter(pk__gt=after_id).order_by(pk_name).values_list(pk_name, 'markup_hash', *source_fields)[:chunk_size])
+        if not rows:
+            return
+        for row in rows:
+            sources = [(source_field, html_field, text)
+                       for (source_field, html_field, optional), text in zip(fields, row[2:])
+                       if text or not optional]
+            digest = source_hash([(source_field, text) for source_field, html_field, text in sources])
+            if force or digest != row[1]:
+                yield row[0], [(html_field, text) for source_field, html_field, text in sources], digest
+        after_id = rows[-1][0]
+
+def _write_batch(model, results):
+    """
+    Writes rendered HTML back with one ``UPDATE`` statement per set
+    of fields, bypassing ``save()`` and its signals.
+    
+    """
+    qn = connection.ops.quote_name
+    extra_fields, extra_values = ('markup_hash', 'render_pending'), [False]
+    if 'last_modified' in [f.name for f in model._meta.fields]:
+        extra_fields, extra_values = extra_fields + ('last_modified',), extra_values + [datetime.datetime.now()]
+    by_fields = {}
+    for pk, rendered, digest in results:
+        html_fields = tuple([html_field for html_field, html in rendered])
+        by_fields.setdefault(html_fields, []).append([html for html_field, html in rendered] + [digest] + extra_values + [pk])
+    cursor = connection.cursor()
+    for html_fields, rows in by_fields.items():
+        columns = [qn(model._meta.get_field(f).column) for f in html_fields + extra_fields]
+        cursor.executemany("UPDATE %s SET %s WHERE %s = %%s" % \
+                           (qn(model._meta.db_table),
+                            ', '.join(['%s = %%s' % column for column in columns]),
+                            qn(model._meta.pk.column)),
+                           rows)
+    transaction.commit_unless_managed()
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', dest='processes', default=None, type='int',
+                    help='Number of worker processes to render with. Defaults to the number of CPUs.'),
+        make_option('--chunk-size', dest='chunk_size', default=200, type='int',
+                    help='Number of objects to read, and write back, at a time.'),
+        make_option('--after-id', dest='after_id', default=0, type='int',
+                    help='Only re-render Entries with an id greater than this; use the last id reported to resume an interrupted run quickly.'),
+        make_option('--force', action='store_true', dest='force', default=False,
+                    help='Re-render objects even if their markup hash shows they are up to date.'),
+        )
+    help = 'Regenerates the HTML of every Entry and Category with the current markup settings.'
+
+    def handle(self, *args, **options):
+        from coltrane.caching import bump_category_generation, bump_entry_generation
+        from coltrane.models import Category, Entry
+        from coltrane.pagecache import purge
+        from coltrane.rendering import render_sources
+        chunk_size = options.get('chunk_size', 200)
+        force = options.get('force', False)
+
+        # Worker processes mustn't share the parent's database connection.
+        connection.close()
+        pool = None
+        if multiprocessing is not None and options.get('processes') != 1:
+            pool = multiprocessing.Pool(options.get('processes'))
+            # Results must come back in order, so that the last id
+            # reported is a safe point to resume from.
+            render = lambda jobs: pool.imap(render_sources, jobs, 8)
+        else:
+            render = lambda jobs: imap(render_sources, jobs)
+
+        try:
+            for model, fields, after_id in ((Category, [('description', 'description_html', False)], 0),
+                                            (Entry, [('body', 'body_html', False), ('excerpt', 'excerpt_html', True)],
+                                             options.get('after_id', 0))):
+                self.rerender(model, fields, after_id, chunk_size, force, render)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        bump_category_generation()
+        bump_entry_generation()
+        # Every cached page shows rendered markup.
+        purge('all')
+
+    def rerender(self, model, fields, after_id, chunk_size, force, render):
+        name = model._meta.verbose_name_plural
+        total = model.objects.filter(pk__gt=after_id).count()
+        self.done = 0
+        self.start = time.time()
+        batch = []
+        for result in render(_stream_jobs(model, fields, after_id, chunk_size, force)):
+            batch.append(result)
+            if len(batch) == chunk_size:
+                self.flush(model, batch, name)
+                batch = []
+        if batch:
+            self.flush(model, batch, name)
+        sys.stdout.write('%s: %d of %d re-rendered in %.1fs\n' % (name, self.done, total, time.time() - self.start))
+
+    def flush(self, model, batch, name):
+        _write_batch(model, batch)
+        self.done += len(batch)
+        sys.stdout.write('%s: %d re-rendered, up to id %s (%.1f per second)\n' % \
+                         (name, self.done, batch[-1][0], self.done / max(time.time() - self.start, 0.001)))
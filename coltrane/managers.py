@@ -1,5 +1,153 @@
 from comment_utils.managers import CommentedObjectManager
-from django.db import models
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, models
+from django.db.models.query import QuerySet
+
+
+class EntryQuerySet(QuerySet):
+    """
+    ``QuerySet`` for the Entry model which can attach related data to
+    whole batches of entries as they're fetched, instead of leaving
+    each entry to look it up on its own.
+    
+    """
+    chunk_size = 100
+
+    # Large text fields left out of the rows fetched in summary mode.
+    summary_deferred = ('body', 'body_html', 'excerpt')
+
+    def __init__(self, model=None, query=None):
+        super(EntryQuerySet, self).__init__(model, query)
+        self._with_comment_counts = False
+        self._with_categorization = False
+        self._summary = False
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_with_comment_counts', self._with_comment_counts)
+        kwargs.setdefault('_with_categorization', self._with_categorization)
+        kwargs.setdefault('_summary', self._summary)
+        return super(EntryQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def _summary_iterator(self):
+        fields = [f for f in self.model._meta.fields if f.name not in self.summary_deferred]
+        deferred = [f.attname for f in self.model._meta.fields if f.name in self.summary_deferred]
+        for row in self.values_list(*[f.name for f in fields]).iterator():
+            obj = self.model(**dict(zip([f.attname for f in fields], row)))
+            for attname in deferred:
+                delattr(obj, attname)
+            obj._deferred_fields = set(deferred)
+            yield obj
+
+    def iterator(self):
+        chunk = []
+        if self._summary:
+            objects = self._summary_iterator()
+        else:
+            objects = super(EntryQuerySet, self).iterator()
+        for obj in objects:
+            chunk.append(obj)
+            if len(chunk) == self.chunk_size:
+                self._fill_batch(chunk)
+                for obj in chunk:
+                    yield obj
+                chunk = []
+        if chunk:
+            self._fill_batch(chunk)
+            for obj in chunk:
+                yield obj
+
+    def _fill_batch(self, entries):
+        if self._with_comment_counts:
+            self._fill_comment_counts(entries)
+        if self._with_categorization:
+            self._fill_categories(entries)
+            self._fill_tags(entries)
+
+    def _fill_comment_counts(self, entries):
+        from coltrane.models import _public_comment_filters, get_comment_model
+        qn = connection.ops.quote_name
+        ctype = ContentType.objects.get_for_model(self.model)
+        ids = [entry.id for entry in entries]
+        filters = _public_comment_filters().items()
+        cursor = connection.cursor()
+        cursor.execute("SELECT %s, COUNT(*) FROM %s WHERE %s = %%s AND %s IN (%s)%s GROUP BY %s" % \
+                       (qn('object_id'), qn(get_comment_model()._meta.db_table),
+                        qn('content_type_id'), qn('object_id'),
+                        ', '.join(['%s'] * len(ids)),
+                        ''.join([' AND %s = %%s' % qn(name) for name, value in filters]),
+                        qn('object_id')),
+                       [ctype.id] + ids + [value for name, value in filters])
+        counts = dict(cursor.fetchall())
+        for entry in entries:
+            entry._comment_count_cache = counts.get(entry.id, 0)
+
+    def _fill_categories(self, entries):
+        qn = connection.ops.quote_name
+        field = self.model._meta.get_field('categories')
+        category_model = field.rel.to
+        table = field.m2m_db_table()
+        entry_column = '%s.%s' % (qn(table), qn(field.m2m_column_name()))
+        ids = [entry.id for entry in entries]
+        categories = category_model._default_manager.extra(select={ '_entry_id': entry_column },
+                                                           tables=[table],
+                                                           where=['%s.%s = %s.%s' % (qn(table), qn(field.m2m_reverse_name()),
+                                                                                     qn(category_model._meta.db_table),
+                                                                                     qn(category_model._meta.pk.column)),
+                                                                  '%s IN (%s)' % (entry_column, ', '.join(['%s'] * len(ids)))],
+                                                           params=ids)
+        by_entry = {}
+        for category in categories:
+            by_entry.setdefault(category._entry_id, []).append(category)
+        for entry in entries:
+            entry._category_list_cache = by_entry.get(entry.id, [])
+
+    def _fill_tags(self, entries):
+        from tagging.models import TaggedItem
+        from tagging.utils import edit_string_for_tags
+        ctype = ContentType.objects.get_for_model(self.model)
+        items = TaggedItem.objects.filter(content_type__pk=ctype.id,
+                                          object_id__in=[entry.id for entry in entries]).select_related()
+        by_entry = {}
+        for item in items:
+            by_entry.setdefault(item.object_id, []).append(item.tag)
+        tag_field = self.model._meta.get_field('tags')
+        for entry in entries:
+            tags = by_entry.get(entry.id, [])
+            tags.sort(key=lambda tag: tag.name)
+            entry._tag_list_cache = tags
+            tag_field._set_instance_tag_cache(entry, edit_string_for_tags(tags))
+
+    def with_categorization(self):
+        """
+        Returns a copy of this ``QuerySet`` which fetches the
+        categories and tags of each batch of entries in two queries,
+        and caches them on each entry for ``Entry.get_categories``,
+        ``Entry.get_tags`` and the ``tags`` field.
+        
+        """
+        return self._clone(_with_categorization=True)
+
+    def with_comment_counts(self):
+        """
+        Returns a copy of this ``QuerySet`` which counts public comments for
+        each batch of entries in one grouped query, and caches the
+        result on each entry for ``Entry._get_comment_count``.
+        
+        """
+        return self._clone(_with_comment_counts=True)
+
+    def summary(self):
+        """
+        Returns a copy of this ``QuerySet`` which fetches every column
+        except the large text fields named in ``summary_deferred``
+        (the body, its HTML and the excerpt source), for list pages
+        which only show metadata and ``excerpt_html``.
+        
+        The left-out fields are loaded, all together in one query,
+        the first time any of them is accessed on an entry.
+        
+        """
+        return self._clone(_summary=True)
 
 
 class LiveEntryManager(CommentedObjectManager):
@@ -21,7 +169,7 @@ class LiveEntryManager(CommentedObjectManager):
         with a status of 'live'.
         
         """
-        return super(LiveEntryManager, self).get_query_set().filter(status__exact=self.model.LIVE_STATUS)
+        return EntryQuerySet(self.model).filter(status__exact=self.model.LIVE_STATUS)
 
     def latest_featured(self):
         """
@@ -33,3 +181,30 @@ class LiveEntryManager(CommentedObjectManager):
             return self.featured()[0]
         except IndexError:
             return None
+
+    def with_comment_counts(self):
+        """
+        Returns a ``QuerySet`` of live Entries whose comment counts
+        are fetched in one query per batch of entries; see
+        ``EntryQuerySet.with_comment_counts``.
+        
+        """
+        return self.get_query_set().with_comment_counts()
+
+    def with_categorization(self):
+        """
+        Returns a ``QuerySet`` of live Entries whose categories and
+        tags are fetched in bulk; see
+        ``EntryQuerySet.with_categorization``.
+        
+        """
+        return self.get_query_set().with_categorization()
+
+    def summary(self):
+        """
+        Returns a ``QuerySet`` of live Entries which leaves out their
+        large text fields until they're accessed; see
+        ``EntryQuerySet.summary``.
+        
+        """
+        return self.get_query_set().summary()
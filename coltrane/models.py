@@ -9,16 +9,20 @@ import datetime
 from comment_utils.managers import CommentedObjectManager
 from comment_utils.moderation import CommentModerator, moderator
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import connection, models
+from django.db.models import signals
+from django.dispatch import dispatcher
 from django.utils.encoding import smart_str
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.comments import models as comment_models
 import tagging
 from tagging.fields import TagField
-from template_utils.markup import formatter
+from tagging.models import Tag
 
-from coltrane import managers
+from coltrane import archive, conditional, counters, deferred, managers, moderation, pagecache, related, rendering, search
+from coltrane.caching import bump_category_generation, bump_entry_generation, entry_cache_key, is_shared
 
 
 class Category(models.Model):
@@ -31,6 +35,9 @@ class Category(models.Model):
                             help_text=u'Used in the URL for the category. Must be unique.')
     description = models.TextField(help_text=u'A short description of the category, to be used in list pages.')
     description_html = models.TextField(editable=False, blank=True)
+    render_pending = models.BooleanField(default=False, editable=False)
+    markup_hash = models.CharField(max_length=32, editable=False, blank=True)
+    live_entry_count = models.IntegerField(u'Number of live entries', default=0, editable=False)
     
     class Meta:
         verbose_name_plural = 'Categories'
@@ -43,8 +50,7 @@ class Category(models.Model):
         return self.title
     
     def save(self):
-        self.description_html = formatter(self.description)
-        super(Category, self).save()
+        rendering.save_rendered(self, [('description', 'description_html')], super(Category, self).save)
     
     def get_absolute_url(self):
         return ('coltrane_category_detail', (), { 'slug': self.slug })
@@ -54,11 +60,18 @@ class Category(models.Model):
         """
         Returns Entries in this Category with status of "live".
         
+        To display how many there are, use the maintained
+        ``live_entry_count`` field instead of counting these.
+        
+        This only builds a query from the Category's ``id``, so it
+        can be used on Categories from ``coltrane.caching.get_category``
+        without looking the Category up again.
+        
         Access this through the property ``live_entry_set``.
         
         """
         from coltrane.models import Entry
-        return self.entry_set.filter(status__exact=Entry.LIVE_STATUS)
+        return Entry.live.filter(categories__id__exact=self.id)
     
     live_entry_set = property(_get_live_entries)
 
@@ -92,6 +105,7 @@ class Entry(models.Model):
     enable_comments = models.BooleanField(default=True)
     featured = models.BooleanField(default=False)
     pub_date = models.DateTimeField(u'Date posted', default=datetime.datetime.today)
+    last_modified = models.DateTimeField(u'Date last modified', auto_now=True, db_index=True)
     slug = models.SlugField(prepopulate_from=('title',),
                             unique_for_date='pub_date',
                             help_text=u'Used in the URL of the entry. Must be unique for the publication date of the entry.')
@@ -104,15 +118,24 @@ class Entry(models.Model):
     body_html = models.TextField(editable=False, blank=True)
     excerpt = models.TextField(blank=True, null=True)
     excerpt_html = models.TextField(blank=True, null=True, editable=False)
+    render_pending = models.BooleanField(default=False, editable=False,
+                                         help_text=u'Set while the HTML versions of the excerpt and body are being rendered in the background.')
+    markup_hash = models.CharField(max_length=32, editable=False, blank=True)
     
     # Categorization.
     categories = models.ManyToManyField(Category, filter_interface=models.HORIZONTAL, blank=True)
     tags = TagField()
     
+    # Denormalized data, kept current by signal handlers.
+    comment_count = models.IntegerField(u'Number of comments', default=0, editable=False)
+    
     # Managers.
     live = managers.LiveEntryManager()
     objects = models.Manager()
     
+    # Composite indexes on (status, pub_date), (status, featured,
+    # pub_date) and (slug, pub_date), matching the queries made through
+    # LiveEntryManager, are created by sql/entry.sql.
     class Meta:
         get_latest_by = 'pub_date'
         ordering = ['-pub_date']
@@ -128,18 +151,33 @@ class Entry(models.Model):
             ('Categorization', { 'fields':
                                  ('tags', 'categories') }),
             )
-        list_display = ('title', 'pub_date', 'author', 'status', 'enable_comments', '_get_comment_count')
+        list_display = ('title', 'pub_date', 'author', 'status', 'enable_comments', 'comment_count')
         list_filter = ('status', 'categories')
         search_fields = ('excerpt', 'body', 'title')
     
     def __unicode__(self):
         return self.title
     
+    def __getattr__(self, name):
+        """
+        Loads the text fields left out of an Entry fetched through
+        ``EntryQuerySet.summary``, in one query, when any of them is
+        first accessed.
+        
+        """
+        deferred_fields = self.__dict__.get('_deferred_fields')
+        if not deferred_fields or name not in deferred_fields:
+            raise AttributeError(name)
+        values = self.__class__.objects.filter(pk=self.pk).values(*deferred_fields)[0]
+        self.__dict__.update(values)
+        del self._deferred_fields
+        return values[name]
+    
     def save(self):
+        fields = [('body', 'body_html')]
         if self.excerpt:
-            self.excerpt_html = formatter(self.excerpt)
-        self.body_html = formatter(self.body)
-        super(Entry, self).save()
+            fields.append(('excerpt', 'excerpt_html'))
+        rendering.save_rendered(self, fields, super(Entry, self).save)
         
     def get_absolute_url(self):
         return ('coltrane_entry_detail', (), { 'year': self.pub_date.strftime('%Y'),
@@ -149,7 +187,27 @@ class Entry(models.Model):
     get_absolute_url = models.permalink(get_absolute_url)
     
     def _next_previous_helper(self, direction):
-        return getattr(self, 'get_%s_by_pub_date' % direction)(status__exact=self.LIVE_STATUS)
+        """
+        Looks up both live neighbors of this Entry by ``pub_date``,
+        caching them for the current Entry generation (when the cache
+        backend is shared), so that ``get_next`` and ``get_previous``
+        usually cost no queries.
+        
+        """
+        if not hasattr(self, '_neighbor_cache'):
+            key = entry_cache_key('%s.neighbors' % self.id)
+            neighbors = is_shared() and cache.get(key) or None
+            if neighbors is None:
+                neighbors = {}
+                for name in ('next', 'previous'):
+                    try:
+                        neighbors[name] = getattr(self, 'get_%s_by_pub_date' % name)(status__exact=self.LIVE_STATUS)
+                    except Entry.DoesNotExist:
+                        neighbors[name] = None
+                if is_shared():
+                    cache.set(key, neighbors)
+            self._neighbor_cache = neighbors
+        return self._neighbor_cache[direction]
     
     def get_next(self):
         """
@@ -176,18 +234,336 @@ class Entry(models.Model):
         """
         return self._next_previous_helper('previous')
 
+    def get_categories(self):
+        """
+        Returns the Categories this Entry belongs to.
+        
+        In list templates, use this method instead of
+        ``categories.all``, because it uses the categories fetched in
+        bulk by ``EntryQuerySet.with_categorization`` when they're
+        available.
+        
+        """
+        if hasattr(self, '_category_list_cache'):
+            categories = self._category_list_cache
+        else:
+            categories = list(self.categories.all())
+        pagecache.depends_on(*[u'category:%s' % category.slug for category in categories])
+        return categories
+    
+    def get_tags(self):
+        """
+        Returns the Tags applied to this Entry.
+        
+        In list templates, use this method instead of ``tag_set``,
+        because it uses the tags fetched in bulk by
+        ``EntryQuerySet.with_categorization`` when they're available.
+        
+        """
+        if hasattr(self, '_tag_list_cache'):
+            return self._tag_list_cache
+        return self.tag_set
+    
+    def get_related(self):
+        """
+        Returns the live Entries most closely related to this one by
+        shared tags and Categories, best match first, as precomputed
+        by ``coltrane.related``.
+        
+        """
+        pagecache.depends_on(u'related:%s' % self.id)
+        return [row.related for row in self.related_entry_set.select_related()]
+    
     def _get_comment_count(self):
-        model = settings.USE_FREE_COMMENTS and comment_models.FreeComment or comment_models.Comment
+        """
+        Counts this Entry's public comments with a query against the
+        comment table.
+        
+        For display, prefer the denormalized ``comment_count`` field,
+        which needs no query at all. If the Entry was fetched through
+        ``EntryQuerySet.with_comment_counts``, the count fetched along
+        with it is returned without another query.
+        
+        """
+        if hasattr(self, '_comment_count_cache'):
+            return self._comment_count_cache
         ctype = ContentType.objects.get_for_model(self)
-        return model.objects.filter(content_type__pk=ctype.id, object_id__exact=self.id).count()
+        return get_comment_model().objects.filter(content_type__pk=ctype.id, object_id__exact=self.id,
+                                                  **_public_comment_filters()).count()
     _get_comment_count.short_description = 'Number of comments'
 
 
+class ArchiveDay(models.Model):
+    """
+    The number of live Entries published on a given day, either
+    overall (when ``category`` is empty) or within one Category.
+    
+    This is the archive index which date-based navigation reads
+    from, instead of running ``DISTINCT`` date queries over the
+    whole entry table. It's kept current by signal handlers in
+    ``coltrane.archive``, and can be rebuilt from scratch with
+    ``manage.py coltrane_rebuild archive``.
+    
+    """
+    category = models.ForeignKey(Category, blank=True, null=True)
+    date = models.DateField(db_index=True)
+    entry_count = models.IntegerField(default=0)
+    
+    class Meta:
+        ordering = ['date']
+        unique_together = (('category', 'date'),)
+    
+    def __unicode__(self):
+        return u'%s: %s' % (self.date, self.entry_count)
+
+
+class SearchPosting(models.Model):
+    """
+    An entry in the full-text search index: the occurrences of one
+    term in one live Entry.
+    
+    Maintained by ``coltrane.search``; ``positions`` holds the word
+    positions of the term, separated by spaces.
+    
+    """
+    term = models.CharField(max_length=50, db_index=True)
+    entry = models.ForeignKey(Entry)
+    frequency = models.IntegerField()
+    positions = models.TextField()
+    
+    def __unicode__(self):
+        return u'%s: %s' % (self.term, self.entry_id)
+
+
+class RelatedEntry(models.Model):
+    """
+    One of the live Entries most closely related to an Entry, with
+    its relatedness score.
+    
+    Maintained by ``coltrane.related``, and can be rebuilt from
+    scratch with ``manage.py coltrane_rebuild related``.
+    
+    """
+    entry = models.ForeignKey(Entry, related_name='related_entry_set')
+    related = models.ForeignKey(Entry, related_name='related_to_set')
+    score = models.FloatField()
+    
+    class Meta:
+        ordering = ['-score']
+        unique_together = (('entry', 'related'),)
+    
+    def __unicode__(self):
+        return u'%s: %s (%s)' % (self.entry_id, self.related_id, self.score)
+
+
+class TagCount(models.Model):
+    """
+    The number of live Entries a tag is applied to.
+    
+    Only tags applied to at least one live Entry have a row. Kept
+    current by signal handlers in ``coltrane.counters``, and can be
+    rebuilt from scratch with ``manage.py coltrane_rebuild counts``.
+    
+    """
+    tag = models.ForeignKey(Tag, unique=True)
+    live_entry_count = models.IntegerField(default=0)
+    
+    class Meta:
+        ordering = ['-live_entry_count']
+    
+    def __unicode__(self):
+        return u'%s: %s' % (self.tag_id, self.live_entry_count)
+
+
+class ModerationTask(models.Model):
+    """
+    A comment waiting in the moderation queue for its spam check
+    and/or notification email.
+    
+    Processed, and deleted when done, by ``coltrane.moderation``;
+    tasks which have run out of attempts are left here with the last
+    error.
+    
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.IntegerField()
+    check_spam = models.BooleanField(default=True)
+    notify = models.BooleanField(default=True)
+    approve = models.BooleanField(default=True,
+                                  help_text=u'Whether to make the comment public if it passes the spam check.')
+    is_spam = models.NullBooleanField()
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=datetime.datetime.now, db_index=True)
+    last_error = models.TextField(blank=True)
+    
+    class Meta:
+        ordering = ['next_attempt']
+    
+    class Admin:
+        list_display = ('content_type', 'object_id', 'attempts', 'next_attempt', 'last_error')
+    
+    def __unicode__(self):
+        return u'%s %s' % (self.content_type, self.object_id)
+
+
+def get_comment_model():
+    """
+    Returns the comment model in use, as selected by the
+    ``USE_FREE_COMMENTS`` setting.
+    
+    """
+    return settings.USE_FREE_COMMENTS and comment_models.FreeComment or comment_models.Comment
+
+def _public_comment_filters():
+    """
+    Returns the field lookups which select the comments visible on
+    the site: public ones, and for ``Comment`` only those which
+    haven't been removed.
+    
+    """
+    filters = { 'is_public': True }
+    if get_comment_model() is comment_models.Comment:
+        filters['is_removed'] = False
+    return filters
+
+def refresh_comment_count(entry_id, touch=False):
+    """
+    Recounts the public comments on the Entry with id ``entry_id``
+    and stores the result in its ``comment_count``.
+
+    If the count changed, or ``touch`` is ``True``, the Entry's
+    ``last_modified`` is updated as well, since its page has changed.
+    
+    """
+    ctype = ContentType.objects.get_for_model(Entry)
+    count = get_comment_model().objects.filter(content_type__pk=ctype.id,
+                                               object_id__exact=entry_id,
+                                               **_public_comment_filters()).count()
+    entries = Entry.objects.filter(pk=entry_id)
+    if not touch:
+        entries = entries.exclude(comment_count=count)
+    entries.update(comment_count=count, last_modified=datetime.datetime.now())
+
+def rebuild_comment_counts():
+    """
+    Recalculates ``comment_count`` for every Entry, using a single
+    grouped query over the comment table.
+    
+    """
+    qn = connection.ops.quote_name
+    ctype = ContentType.objects.get_for_model(Entry)
+    filters = _public_comment_filters().items()
+    cursor = connection.cursor()
+    cursor.execute("SELECT %s, COUNT(*) FROM %s WHERE %s = %%s%s GROUP BY %s" % \
+                   (qn('object_id'), qn(get_comment_model()._meta.db_table),
+                    qn('content_type_id'),
+                    ''.join([' AND %s = %%s' % qn(name) for name, value in filters]),
+                    qn('object_id')),
+                   [ctype.id] + [value for name, value in filters])
+    counts = dict(cursor.fetchall())
+    Entry.objects.update(comment_count=0)
+    for entry_id, count in counts.items():
+        Entry.objects.filter(pk=entry_id).update(comment_count=count)
+
+def remember_entry_state(sender, instance, **kwargs):
+    """
+    Signal handler which, before an Entry is saved or deleted, records
+    the values its date, status, slug and featured fields had in the
+    database, and the sets of ids of the Categories and tags it
+    belonged to, so that handlers run afterwards can tell what
+    changed.
+    
+    The values are stored as a dictionary in
+    ``instance._original_state`` (under the keys 'pub_date', 'status',
+    'slug', 'featured', 'categories' and 'tags'), which is ``None``
+    for a new Entry.
+    
+    """
+    instance._original_state = None
+    if instance.id:
+        try:
+            original = Entry.objects.filter(pk=instance.id).values('pub_date', 'status', 'slug', 'featured')[0]
+        except IndexError:
+            return
+        original['categories'] = set(instance.categories.values_list('id', flat=True))
+        original['tags'] = counters.entry_tag_ids(instance)
+        instance._original_state = original
+
+def update_entry_comment_count(sender, instance, **kwargs):
+    """
+    Signal handler which refreshes the ``comment_count`` of the Entry
+    a comment is attached to, whenever that comment is saved or
+    deleted. Only public comments are counted, so the count changes
+    when a comment is approved or removed.
+    
+    """
+    if instance.content_type_id != ContentType.objects.get_for_model(Entry).id:
+        return
+    # A public comment shows on the page even if the count is the same.
+    refresh_comment_count(instance.object_id, touch=instance.is_public)
+
+
 class ColtraneModerator(CommentModerator):
+    """
+    Comment moderation for Entries which runs the Akismet check and
+    notification email in the background, through the queue in
+    ``coltrane.moderation``, rather than during the request.
+    
+    With ``akismet`` set, new comments are saved as not public, and
+    made public once they pass the spam check (unless the age of the
+    Entry means they're held for moderation anyway).
+    
+    """
     akismet = True
     auto_close_field = 'pub_date'
     email_notification = True
     enable_field = 'enable_comments'
     close_after = settings.COMMENTS_MODERATE_AFTER
+    
+    def moderate(self, comment, content_object):
+        held = False
+        if self.auto_moderate_field and self.moderate_after:
+            held = self._get_delta(datetime.datetime.now(),
+                                   getattr(content_object, self.auto_moderate_field)).days >= self.moderate_after
+        comment._coltrane_approve = self.akismet and not held
+        return self.akismet or held
+    
+    def email(self, comment, content_object):
+        # Only new comments have been through ``moderate``.
+        if not hasattr(comment, '_coltrane_approve'):
+            return
+        moderation.enqueue(comment, check_spam=self.akismet, notify=self.email_notification,
+                           approve=comment._coltrane_approve)
 
 tagging.register(Entry, 'tag_set')
+
+dispatcher.connect(bump_category_generation, signal=signals.post_save, sender=Category)
+dispatcher.connect(bump_category_generation, signal=signals.post_delete, sender=Category)
+dispatcher.connect(pagecache.remember_category_slug, signal=signals.pre_save, sender=Category)
+dispatcher.connect(pagecache.purge_category_pages, signal=signals.post_save, sender=Category)
+dispatcher.connect(pagecache.purge_category_pages, signal=signals.post_delete, sender=Category)
+dispatcher.connect(remember_entry_state, signal=signals.pre_save, sender=Entry)
+dispatcher.connect(remember_entry_state, signal=signals.pre_delete, sender=Entry)
+dispatcher.connect(deferred.entry_saved, signal=signals.post_save, sender=Entry)
+dispatcher.connect(deferred.entry_deleted, signal=signals.post_delete, sender=Entry)
+deferred.connect(archive.update_archive_index)
+dispatcher.connect(archive.update_archive_index, signal=signals.post_delete, sender=Entry)
+deferred.connect(conditional.note_moved_entry)
+dispatcher.connect(conditional.note_deleted_entry, signal=signals.post_delete, sender=Entry)
+dispatcher.connect(search.update_search_index, signal=signals.post_save, sender=Entry)
+dispatcher.connect(search.remove_from_search_index, signal=signals.pre_delete, sender=Entry)
+deferred.connect(related.update_related_entries)
+dispatcher.connect(related.remember_related_listing, signal=signals.pre_delete, sender=Entry)
+dispatcher.connect(related.remove_related_entries, signal=signals.post_delete, sender=Entry)
+deferred.connect(counters.update_entry_counts)
+dispatcher.connect(counters.remove_entry_counts, signal=signals.post_delete, sender=Entry)
+dispatcher.connect(bump_entry_generation, signal=signals.post_save, sender=Entry)
+dispatcher.connect(bump_entry_generation, signal=signals.post_delete, sender=Entry)
+deferred.connect(pagecache.purge_entry_pages)
+dispatcher.connect(pagecache.purge_deleted_entry_pages, signal=signals.post_delete, sender=Entry)
+
+for comment_model in (comment_models.FreeComment, comment_models.Comment):
+    dispatcher.connect(update_entry_comment_count, signal=signals.post_save, sender=comment_model)
+    dispatcher.connect(update_entry_comment_count, signal=signals.post_delete, sender=comment_model)
+    dispatcher.connect(pagecache.purge_comment_pages, signal=signals.post_save, sender=comment_model)
+    dispatcher.connect(pagecache.purge_comment_pages, signal=signals.post_delete, sender=comment_model)
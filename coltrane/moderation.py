@@ -0,0 +1,295 @@
+"""
+A queue which takes comment spam checks and notification emails out
+of the request/response cycle.
+
+``ColtraneModerator`` saves new comments as not public and queues a
+``ModerationTask`` for each. A background worker thread then handles
+the queued tasks in batches of up to ``COLTRANE_MODERATION_BATCH_SIZE``
+(default 20). It checks each batch with the spam checker named by the
+``COLTRANE_SPAM_CHECKER`` setting (default ``AkismetChecker``), makes
+the comments which pass public, and reports the batch in one message
+through the notifier named by ``COLTRANE_COMMENT_NOTIFIER`` (default
+``EmailNotifier``). For local testing, point those settings at
+``StubChecker`` and ``StubNotifier``.
+
+A batch whose check or notification fails is retried after
+``COLTRANE_MODERATION_RETRY_DELAY`` seconds (default 60), doubling
+each time, up to ``COLTRANE_MODERATION_MAX_ATTEMPTS`` attempts
+(default 5); tasks which run out of attempts stay in the queue for
+inspection. ``manage.py coltrane_moderate`` processes the queue from
+the command line, for example after a restart.
+
+"""
+
+import datetime
+import logging
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core import signals as core_signals
+from django.core.mail import send_mail
+from django.db import connection, transaction
+from django.dispatch import dispatcher
+from django.template import Context, loader
+from django.utils.encoding import smart_str
+
+from coltrane.caching import bump_entry_generation
+from coltrane.pagecache import purge_entry_pages_by_id
+from coltrane.workers import WorkerPool
+
+
+def _setting(name, default):
+    return getattr(settings, 'COLTRANE_MODERATION_%s' % name, default)
+
+def _load(path):
+    module, name = path.rsplit('.', 1)
+    return getattr(__import__(module, {}, {}, [name]), name)()
+
+
+class AkismetChecker(object):
+    """
+    Checks comments with the Akismet service, using the
+    ``AKISMET_API_KEY`` setting. The key is verified once per batch.
+    
+    """
+    def check(self, comments):
+        """
+        Returns a list of booleans, ``True`` where the corresponding
+        one of ``comments`` is spam. Network errors propagate, so
+        that the batch is retried.
+        
+        """
+        from akismet import Akismet
+        api = Akismet(key=settings.AKISMET_API_KEY,
+                      blog_url='http://%s/' % Site.objects.get_current().domain)
+        if not api.verify_key():
+            raise ValueError('Akismet rejected the API key')
+        return [bool(api.comment_check(smart_str(comment.comment),
+                                       data={ 'comment_type': 'comment',
+                                              'referrer': '',
+                                              'user_ip': comment.ip_address,
+                                              'user_agent': '' },
+                                       build_data=True))
+                for comment in comments]
+
+
+class StubChecker(object):
+    """
+    A local stand-in for ``AkismetChecker``, which treats comments
+    containing any of the words in the ``COLTRANE_STUB_SPAM_WORDS``
+    setting (default just 'spam') as spam, and records every comment
+    it checks in ``StubChecker.checked``.
+    
+    """
+    checked = []
+
+    def check(self, comments):
+        words = getattr(settings, 'COLTRANE_STUB_SPAM_WORDS', ('spam',))
+        StubChecker.checked.extend(comments)
+        return [bool([word for word in words if word in comment.comment.lower()]) for comment in comments]
+
+
+class EmailNotifier(object):
+    """
+    Emails the site's managers one message per batch of comments,
+    rendering ``comment_utils/comment_notification_email.txt`` for
+    each comment, with ``is_spam`` added to its context.
+    
+    """
+    def notify(self, results):
+        """
+        Sends a notification for ``results``, a list of ``(comment,
+        is_spam)`` pairs. Mail errors propagate, so that the batch is
+        retried.
+        
+        """
+        template = loader.get_template('comment_utils/comment_notification_email.txt')
+        message = u'\n\n'.join([template.render(Context({ 'comment': comment,
+                                                          'content_object': comment.get_content_object(),
+                                                          'is_spam': is_spam }))
+                                for comment, is_spam in results])
+        subject = '[%s] %d new comments posted' % (Site.objects.get_current().name, len(results))
+        send_mail(subject, message, settings.DEFAULT_FROM_EMAIL,
+                  [manager[1] for manager in settings.MANAGERS])
+
+
+class StubNotifier(object):
+    """
+    A local stand-in for ``EmailNotifier``, which appends each batch
+    of ``(comment, is_spam)`` pairs to ``StubNotifier.outbox``.
+    
+    """
+    outbox = []
+
+    def notify(self, results):
+        StubNotifier.outbox.append(list(results))
+
+
+_pool = WorkerPool(1)
+
+# Whether a run of the queue is already waiting for the worker, so
+# that a burst of comments is handled as one batch.
+_scheduled = threading.Event()
+
+# Set when a task is queued inside a managed transaction, so that the
+# worker is started once the request has finished and the task has
+# been committed.
+_deferred = threading.local()
+
+
+def _claim(tasks, now):
+    """
+    Pushes back the next attempt of each of ``tasks`` while this
+    process works on them, returning those which no other process had
+    claimed first.
+    
+    """
+    from coltrane.models import ModerationTask
+    qn = connection.ops.quote_name
+    opts = ModerationTask._meta
+    until = now + datetime.timedelta(seconds=_setting('CLAIM_TIMEOUT', 300))
+    cursor = connection.cursor()
+    claimed = []
+    for task in tasks:
+        cursor.execute("UPDATE %s SET %s = %%s WHERE %s = %%s AND %s = %%s" % \
+                       (qn(opts.db_table), qn('next_attempt'), qn(opts.pk.column), qn('next_attempt')),
+                       [until, task.id, task.next_attempt])
+        if cursor.rowcount:
+            claimed.append(task)
+    transaction.commit_unless_managed()
+    return claimed
+
+def _fail(tasks, error):
+    from coltrane.models import ModerationTask
+    logging.getLogger('coltrane').error('Comment moderation failed: %s' % error)
+    now = datetime.datetime.now()
+    for task in tasks:
+        task.attempts += 1
+        delay = _setting('RETRY_DELAY', 60) * 2 ** (task.attempts - 1)
+        ModerationTask.objects.filter(pk=task.id).update(attempts=task.attempts,
+                                                         next_attempt=now + datetime.timedelta(seconds=delay),
+                                                         last_error=unicode(error))
+
+def process_batch(tasks):
+    """
+    Checks, approves and notifies the comments of ``tasks``, deleting
+    each task once it's done, or rescheduling the whole batch if the
+    spam checker or notifier fails.
+    
+    """
+    from coltrane.models import Entry, ModerationTask, refresh_comment_count
+    comments = []
+    for task in tasks:
+        model = task.content_type.model_class()
+        try:
+            comments.append((task, model._default_manager.get(pk=task.object_id)))
+        except model.DoesNotExist:
+            task.delete()
+
+    to_check = [(task, comment) for task, comment in comments if task.check_spam and task.is_spam is None]
+    if to_check:
+        try:
+            verdicts = _load(getattr(settings, 'COLTRANE_SPAM_CHECKER', 'coltrane.moderation.AkismetChecker')).check([comment for task, comment in to_check])
+        except Exception:
+            _fail([task for task, comment in comments], sys.exc_info()[1])
+            return
+        approved = []
+        for (task, comment), is_spam in zip(to_check, verdicts):
+            task.is_spam = is_spam
+            ModerationTask.objects.filter(pk=task.id).update(is_spam=is_spam)
+            if task.approve and not is_spam:
+                comment.__class__._default_manager.filter(pk=comment.id).update(is_public=True)
+                comment.is_public = True
+                approved.append(comment)
+        for comment in approved:
+            if comment.content_type.model_class() is Entry:
+                # The update above sends no signals, so the count
+                # kept by update_entry_comment_count is stale.
+                refresh_comment_count(comment.object_id)
+                purge_entry_pages_by_id(comment.object_id)
+        if approved:
+            bump_entry_generation()
+
+    to_notify = [(comment, task.is_spam) for task, comment in comments if task.notify]
+    if to_notify:
+        try:
+            _load(getattr(settings, 'COLTRANE_COMMENT_NOTIFIER', 'coltrane.moderation.EmailNotifier')).notify(to_notify)
+        except Exception:
+            _fail([task for task, comment in comments], sys.exc_info()[1])
+            return
+    ModerationTask.objects.filter(pk__in=[task.id for task, comment in comments]).delete()
+    transaction.commit_unless_managed()
+
+def process_queue():
+    """
+    Processes every queued task which is due, a batch at a time,
+    returning the number of tasks processed.
+    
+    """
+    from coltrane.models import ModerationTask
+    processed = 0
+    while True:
+        now = datetime.datetime.now()
+        due = ModerationTask.objects.filter(attempts__lt=_setting('MAX_ATTEMPTS', 5),
+                                            next_attempt__lte=now).order_by('next_attempt')
+        tasks = _claim(list(due.select_related()[:_setting('BATCH_SIZE', 20)]), now)
+        if not tasks:
+            return processed
+        process_batch(tasks)
+        processed += len(tasks)
+
+def _run():
+    from coltrane.models import ModerationTask
+    # Give a burst of comments a moment to arrive, so it's handled
+    # in as few batches as possible.
+    time.sleep(_setting('BATCH_WAIT', 1))
+    _scheduled.clear()
+    process_queue()
+    # Come back for tasks waiting to be retried.
+    retries = ModerationTask.objects.filter(attempts__lt=_setting('MAX_ATTEMPTS', 5),
+                                            next_attempt__gt=datetime.datetime.now()).order_by('next_attempt')
+    for next_attempt in retries.values_list('next_attempt', flat=True)[:1]:
+        delay = next_attempt - datetime.datetime.now()
+        timer = threading.Timer(max(delay.days * 86400 + delay.seconds + 1, 1), schedule)
+        timer.setDaemon(True)
+        timer.start()
+
+def schedule(**kwargs):
+    """
+    Has the background worker process the queue, unless it's already
+    due to.
+    
+    """
+    if not _scheduled.isSet():
+        _scheduled.set()
+        _pool.submit(_run)
+
+def _schedule_deferred(**kwargs):
+    if getattr(_deferred, 'pending', False):
+        _deferred.pending = False
+        schedule()
+
+def enqueue(comment, check_spam=True, notify=True, approve=True):
+    """
+    Queues ``comment`` for a spam check (if ``check_spam``), after
+    which it's made public if ``approve`` and it isn't spam, and for
+    notification (if ``notify``).
+    
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from coltrane.models import ModerationTask
+    if not (check_spam or notify):
+        return
+    ModerationTask.objects.create(content_type=ContentType.objects.get_for_model(comment),
+                                  object_id=comment.id, check_spam=check_spam,
+                                  notify=notify, approve=approve,
+                                  next_attempt=datetime.datetime.now())
+    if transaction.is_managed():
+        _deferred.pending = True
+    else:
+        schedule()
+
+dispatcher.connect(_schedule_deferred, signal=core_signals.request_finished)
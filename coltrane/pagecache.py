@@ -0,0 +1,400 @@
+"""
+A full-page cache for coltrane's views, invalidated by dependency
+tags rather than by expiry.
+
+Each cached page records the tags it depends on, with the version
+each tag had when the page was rendered; purging a tag gives it a new
+version, so every page depending on it is re-rendered on its next
+request while all other pages stay cached. The tags are:
+
+``entry:<YYYY-MM-DD>/<slug>``
+    An Entry's detail page.
+
+``day:<YYYY-MM-DD>``, ``month:<YYYY-MM>``, ``year:<YYYY>``, ``index``
+    The date archives and the archive index.
+
+``category:<slug>``
+    A Category's pages, and any page showing the Category's name.
+
+``categories``, ``featured``, ``archive``, ``tags``, ``related:<id>``
+    Pages showing the category list, the featured entries, archive
+    navigation, the tag cloud or an Entry's related entries.
+
+``all``
+    Every cached page.
+
+A view's own tags come from its URL arguments; tags for what's shown
+around the main content are added by the template tags and methods
+which show it, through ``depends_on``.
+
+Saving or deleting an Entry purges the pages showing it in its old
+and new state (its detail page, its old and new neighbors' detail
+pages, and the listings it's in), and the archive navigation,
+category list and tag cloud only when it joined or left a date,
+Category or tag. On save this happens after the admin has written
+the Entry's categories (see ``coltrane.deferred``). Comments and
+background renders purge only the Entry's detail page and the
+listings it's in, and saving or deleting a Category purges its
+pages.
+
+Nothing is saved when an Entry with a future ``pub_date`` comes due,
+so no page is kept beyond the next such ``pub_date``, when the Entry
+starts to appear on the site.
+
+Only successful GET responses for anonymous users are cached, and
+only with a cache backend shared by every process (see
+``coltrane.caching.is_shared``). Set ``COLTRANE_PAGE_CACHE`` to
+``True`` to turn the cache on; pages are kept for
+``COLTRANE_PAGE_CACHE_TIMEOUT`` seconds (default one day) at most.
+
+"""
+
+import datetime
+import threading
+import time
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.encoding import smart_str
+
+from coltrane.caching import GENERATION_TIMEOUT, is_shared
+
+
+# The tags collected while the current thread renders a cacheable
+# page, or while ``start_collecting`` is in effect, or None.
+_collected = threading.local()
+
+
+def _tag_key(tag):
+    return 'coltrane.pagecache.tag.%s' % md5(tag.encode('utf-8')).hexdigest()
+
+def _new_version():
+    return '%.6f' % time.time()
+
+def tag_versions(tags):
+    """
+    Returns a dictionary of the current version of each of ``tags``,
+    giving a new version to any which don't have one.
+    
+    """
+    keys = dict([(tag, _tag_key(tag)) for tag in tags])
+    stored = cache.get_many(keys.values())
+    versions = {}
+    for tag, key in keys.items():
+        if key not in stored:
+            stored[key] = _new_version()
+            cache.set(key, stored[key], GENERATION_TIMEOUT)
+        versions[tag] = stored[key]
+    return versions
+
+def purge(*tags):
+    """
+    Invalidates every cached page depending on any of ``tags``.
+    
+    """
+    version = _new_version()
+    for tag in tags:
+        cache.set(_tag_key(tag), version, GENERATION_TIMEOUT)
+
+def depends_on(*tags):
+    """
+    Records that the page being rendered by the current thread, if
+    its tags are being collected, depends on ``tags``.
+    
+    """
+    collected = getattr(_collected, 'tags', None)
+    if collected is not None:
+        collected.update(tags)
+
+def start_collecting():
+    """
+    Starts collecting the tags of the pages the current thread
+    renders, whether or not they're cached, for ``stop_collecting``
+    to return.
+    
+    """
+    _collected.tags = set()
+
+def stop_collecting():
+    """
+    Stops collecting tags, returning the set collected since
+    ``start_collecting`` was called.
+    
+    """
+    collected = getattr(_collected, 'tags', None) or set()
+    _collected.tags = None
+    return collected
+
+def _date(year, month=None, day=None):
+    try:
+        return datetime.date(*time.strptime('%s-%s-%s' % (year, month or 'jan', day or '01'), '%Y-%b-%d')[:3])
+    except ValueError:
+        return None
+
+def date_tags(date):
+    """
+    Returns the tags of the day, month and year archives containing
+    ``date``.
+    
+    """
+    return [date.strftime('day:%Y-%m-%d'), date.strftime('month:%Y-%m'), date.strftime('year:%Y')]
+
+def entry_tag(pub_date, slug):
+    return u'entry:%s/%s' % (pub_date.strftime('%Y-%m-%d'), slug)
+
+def archive_tags(request, year=None, month=None, day=None, **kwargs):
+    """
+    Tags for the entry archive views.
+    
+    """
+    if year is None:
+        return ['index']
+    date = _date(year, month, day)
+    if date is None:
+        return []
+    if day is not None:
+        return [date_tags(date)[0]]
+    if month is not None:
+        return [date_tags(date)[1]]
+    return [date_tags(date)[2]]
+
+def entry_tags(request, year, month, day, slug, **kwargs):
+    """
+    Tags for the entry detail view.
+    
+    """
+    date = _date(year, month, day)
+    if date is None:
+        return []
+    return [entry_tag(date, slug)]
+
+def category_tags(request, slug, **kwargs):
+    """
+    Tags for the category views.
+    
+    """
+    return [u'category:%s' % slug]
+
+def category_list_tags(request, **kwargs):
+    """
+    Tags for the category list view.
+    
+    """
+    return ['categories']
+
+def _page_key(request):
+    return 'coltrane.pagecache.page.%s' % md5(smart_str(request.get_full_path())).hexdigest()
+
+def _is_cacheable(request):
+    if not getattr(settings, 'COLTRANE_PAGE_CACHE', False) or request.method != 'GET' or not is_shared():
+        return False
+    user = getattr(request, 'user', None)
+    return user is None or not user.is_authenticated()
+
+def _page_timeout():
+    """
+    Returns the number of seconds a page rendered now can be kept:
+    the configured timeout, or less if a live Entry is due to be
+    published before then.
+    
+    """
+    from coltrane.models import Entry
+    timeout = getattr(settings, 'COLTRANE_PAGE_CACHE_TIMEOUT', 60 * 60 * 24)
+    now = datetime.datetime.now()
+    for pub_date in Entry.live.filter(pub_date__gt=now).order_by('pub_date').values_list('pub_date', flat=True)[:1]:
+        delta = pub_date - now
+        timeout = min(timeout, delta.days * 24 * 60 * 60 + delta.seconds + 1)
+    return timeout
+
+def cache_page(tags):
+    """
+    Returns a decorator for a view which caches its pages, each
+    depending on the tags returned by ``tags`` (called with the
+    view's arguments) and on any recorded with ``depends_on`` while
+    it was rendered.
+
+    A cached page keeps the ``ETag`` the view gave it, and requests
+    whose ``If-None-Match`` matches it get a 304 response.
+    
+    """
+    def decorator(view):
+        def wrapped(request, *args, **kwargs):
+            # Tags being collected around this page, by
+            # start_collecting, get this page's tags as well.
+            outer = getattr(_collected, 'tags', None)
+            if not _is_cacheable(request):
+                if outer is not None:
+                    outer.update(tags(request, *args, **kwargs))
+                return view(request, *args, **kwargs)
+            key = _page_key(request)
+            cached = cache.get(key)
+            if cached is not None:
+                versions, content, headers = cached
+                if tag_versions(versions.keys()) == versions:
+                    etag = dict(headers).get('ETag')
+                    if etag is not None and etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+                        response = HttpResponseNotModified()
+                    else:
+                        response = HttpResponse(content)
+                    for header, value in headers:
+                        response[header] = value
+                    depends_on(*versions.keys())
+                    return response
+            started = time.time()
+            _collected.tags = set(['all'] + list(tags(request, *args, **kwargs)))
+            try:
+                response = view(request, *args, **kwargs)
+                collected = _collected.tags
+            finally:
+                _collected.tags = outer
+            depends_on(*collected)
+            if response.status_code == 200:
+                versions = tag_versions(collected)
+                # A tag purged while the page was rendering may have
+                # been rendered from the old data; don't keep it.
+                if not [version for version in versions.values() if float(version) >= started]:
+                    cache.set(key, (versions, response.content, response.items()), _page_timeout())
+            return response
+        wrapped.__doc__ = view.__doc__
+        return wrapped
+    return decorator
+
+def neighbor_tags(pub_date, exclude_id):
+    """
+    Returns the tags of the detail pages of the live Entries either
+    side of ``pub_date``, other than the one with id ``exclude_id``.
+    
+    """
+    from coltrane.models import Entry
+    tags = []
+    for neighbors in (Entry.live.filter(pub_date__lt=pub_date).order_by('-pub_date'),
+                      Entry.live.filter(pub_date__gt=pub_date).order_by('pub_date')):
+        for neighbor_date, slug in neighbors.exclude(id=exclude_id).values_list('pub_date', 'slug')[:1]:
+            tags.append(entry_tag(neighbor_date, slug))
+    return tags
+
+def _category_slugs(category_ids):
+    from coltrane.models import Category
+    return Category.objects.filter(id__in=list(category_ids)).values_list('slug', flat=True)
+
+def entry_page_tags(pub_date, slug, category_slugs, featured):
+    """
+    Returns the tags of the pages showing a live Entry's text or
+    comment count: its detail page and the listings it's in.
+    
+    """
+    tags = [entry_tag(pub_date, slug), 'index'] + date_tags(pub_date)
+    tags += [u'category:%s' % category_slug for category_slug in category_slugs]
+    if featured:
+        tags.append('featured')
+    return tags
+
+def _purge_entry(instance, is_live):
+    from coltrane.counters import entry_tag_ids
+    original = getattr(instance, '_original_state', None)
+    was_live = original is not None and original['status'] == instance.LIVE_STATUS
+    tags = []
+    moved = was_live != is_live
+    if is_live:
+        categories = set(instance.categories.values_list('id', flat=True))
+        tags += entry_page_tags(instance.pub_date, instance.slug, _category_slugs(categories), instance.featured)
+        tags += neighbor_tags(instance.pub_date, instance.id)
+        moved = moved or original['pub_date'] != instance.pub_date or \
+                original['categories'] != categories or original['tags'] != entry_tag_ids(instance)
+    if was_live:
+        tags += entry_page_tags(original['pub_date'], original['slug'],
+                                 _category_slugs(original['categories']), original['featured'])
+        tags += neighbor_tags(original['pub_date'], instance.id)
+    if moved:
+        # The archive navigation, category list and tag cloud count
+        # Entries, so they only change when one joins or leaves.
+        tags += ['archive', 'categories', 'tags']
+    purge(*tags)
+
+def purge_entry_pages(sender, instance, **kwargs):
+    """
+    Signal handler which purges the pages depending on an Entry's
+    state before and after it's saved. It's called through
+    ``coltrane.deferred``, so that it sees the categories the admin
+    writes after saving the Entry.
+    
+    """
+    _purge_entry(instance, instance.status == instance.LIVE_STATUS)
+
+def purge_deleted_entry_pages(sender, instance, **kwargs):
+    """
+    Signal handler which purges the pages depending on an Entry when
+    it's deleted.
+    
+    """
+    _purge_entry(instance, False)
+
+def purge_entry_pages_by_id(entry_id):
+    """
+    Purges the pages showing the Entry with id ``entry_id``, for
+    changes which don't affect where it's listed: new comments and
+    newly rendered HTML.
+    
+    """
+    from coltrane.models import Category, Entry
+    rows = list(Entry.live.filter(pk=entry_id).values_list('pub_date', 'slug', 'featured'))
+    if not rows:
+        return
+    pub_date, slug, featured = rows[0]
+    purge(*entry_page_tags(pub_date, slug,
+                            Category.objects.filter(entry__id__exact=entry_id).values_list('slug', flat=True),
+                            featured))
+
+def purge_rendered_pages(model, pk):
+    """
+    Purges the pages showing the Entry or Category of ``model`` with
+    primary key ``pk``, after its HTML has been rendered in the
+    background.
+    
+    """
+    from coltrane.models import Category
+    if model is Category:
+        slugs = list(Category.objects.filter(pk=pk).values_list('slug', flat=True))
+        purge(*['categories'] + [u'category:%s' % slug for slug in slugs])
+    else:
+        purge_entry_pages_by_id(pk)
+
+def purge_comment_pages(sender, instance, **kwargs):
+    """
+    Signal handler which purges the pages of the Entry a comment is
+    attached to when the comment is saved or deleted.
+    
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from coltrane.models import Entry
+    if instance.content_type_id == ContentType.objects.get_for_model(Entry).id:
+        purge_entry_pages_by_id(instance.object_id)
+
+def remember_category_slug(sender, instance, **kwargs):
+    """
+    Signal handler which records the slug a Category had before it's
+    saved, so that the pages under that slug can be purged.
+    
+    """
+    from coltrane.models import Category
+    instance._original_slug = None
+    if instance.id:
+        slugs = list(Category.objects.filter(pk=instance.id).values_list('slug', flat=True))
+        instance._original_slug = slugs and slugs[0] or None
+
+def purge_category_pages(sender, instance, **kwargs):
+    """
+    Signal handler which purges the pages of a Category, under its old
+    and new slugs, and the category list, when it's saved or deleted.
+    
+    """
+    tags = ['categories', u'category:%s' % instance.slug]
+    if getattr(instance, '_original_slug', None):
+        tags.append(u'category:%s' % instance._original_slug)
+    purge(*tags)
@@ -0,0 +1,104 @@
+"""
+Keyset ("seek") pagination of Entries.
+
+Instead of an ``OFFSET`` and a page number, each page is located by
+an opaque cursor encoding the ``pub_date`` and ``id`` of the Entry at
+its edge, and the next page is fetched with a ``WHERE`` clause that
+seeks past that Entry. No count of the whole list is needed, and a
+deep page costs the same as the first.
+
+"""
+
+import base64
+import datetime
+
+from django.db.models import Q
+from django.http import Http404
+
+
+class KeysetPage(object):
+    """
+    One page of Entries, newest first, with cursors for the
+    neighboring pages.
+    
+    """
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next = has_next and bool(object_list)
+        self.has_previous = has_previous and bool(object_list)
+        self.next_cursor = self.has_next and encode_cursor(object_list[-1]) or None
+        self.previous_cursor = self.has_previous and encode_cursor(object_list[0]) or None
+
+    def context(self, template_object_name='object'):
+        """
+        Returns the template context variables for this page.
+        
+        """
+        return { '%s_list' % template_object_name: self.object_list,
+                 'is_paginated': self.has_next or self.has_previous,
+                 'has_next': self.has_next,
+                 'has_previous': self.has_previous,
+                 'next_cursor': self.next_cursor,
+                 'previous_cursor': self.previous_cursor }
+
+
+def encode_cursor(entry):
+    """
+    Returns an opaque, URL-safe cursor identifying ``entry``'s
+    position in a list ordered by ``pub_date`` and ``id``.
+    
+    """
+    value = '%s.%06d.%d' % (entry.pub_date.strftime('%Y%m%d%H%M%S'), entry.pub_date.microsecond, entry.id)
+    return base64.urlsafe_b64encode(value).rstrip('=')
+
+def decode_cursor(cursor):
+    """
+    Returns the ``(pub_date, id)`` pair encoded in ``cursor``, raising
+    ``ValueError`` if it isn't a valid cursor.
+    
+    """
+    try:
+        value = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4))
+        timestamp, microsecond, pk = value.split('.')
+        pub_date = datetime.datetime(int(timestamp[:4]), int(timestamp[4:6]), int(timestamp[6:8]),
+                                     int(timestamp[8:10]), int(timestamp[10:12]), int(timestamp[12:14]),
+                                     int(microsecond))
+        return pub_date, int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid pagination cursor: %r" % cursor)
+
+def keyset_page(queryset, per_page, after=None, before=None):
+    """
+    Returns a ``KeysetPage`` of up to ``per_page`` Entries from
+    ``queryset``, newest first: the first page, or the page following
+    the cursor ``after``, or the page preceding the cursor ``before``.
+    
+    """
+    if after:
+        pub_date, pk = decode_cursor(after)
+        queryset = queryset.filter(Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, id__lt=pk))
+    elif before:
+        pub_date, pk = decode_cursor(before)
+        queryset = queryset.filter(Q(pub_date__gt=pub_date) | Q(pub_date=pub_date, id__gt=pk))
+    if before:
+        object_list = list(queryset.order_by('pub_date', 'id')[:per_page + 1])
+        more = len(object_list) > per_page
+        object_list = object_list[:per_page]
+        object_list.reverse()
+        return KeysetPage(object_list, True, more)
+    object_list = list(queryset.order_by('-pub_date', '-id')[:per_page + 1])
+    return KeysetPage(object_list[:per_page], len(object_list) > per_page, bool(after))
+
+def keyset_page_for_request(request, queryset, per_page):
+    """
+    Returns the ``KeysetPage`` of ``queryset`` selected by the
+    ``after`` or ``before`` cursor in ``request.GET``, raising
+    ``Http404`` for an invalid cursor.
+    
+    """
+    try:
+        return keyset_page(queryset, per_page,
+                           after=request.GET.get('after'),
+                           before=request.GET.get('before'))
+    except ValueError:
+        raise Http404
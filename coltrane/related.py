@@ -0,0 +1,195 @@
+"""
+Precomputed lists of related entries.
+
+Two live Entries are related by the tags and Categories they share;
+each shared tag is worth ``COLTRANE_RELATED_TAG_WEIGHT`` (default 2)
+and each shared Category ``COLTRANE_RELATED_CATEGORY_WEIGHT``
+(default 1), and the total is reduced the further apart the Entries
+were published, halving for every ``COLTRANE_RELATED_HALF_LIFE`` days
+(default 365) between them. The scores are symmetric.
+
+The best ``COLTRANE_RELATED_ENTRIES`` (default 5) for each Entry are
+stored in the ``RelatedEntry`` model, and refreshed when an Entry is
+saved or deleted: the Entry's own list is recomputed, as are the
+lists of Entries which currently include it, and it's added to the
+lists of its best-scoring candidates where it now ranks. Use
+``manage.py coltrane_rebuild related`` to recompute every list.
+
+"""
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+
+from coltrane.pagecache import purge
+
+
+# Number of an Entry's best candidates whose own lists are checked
+# for it when it's saved.
+RECIPROCAL_CANDIDATES = 50
+
+
+def _setting(name, default):
+    return getattr(settings, 'COLTRANE_RELATED_%s' % name, default)
+
+def score(shared_tags, shared_categories, days_apart):
+    """
+    Returns the relatedness score of two Entries.
+    
+    """
+    overlap = shared_tags * _setting('TAG_WEIGHT', 2.0) + shared_categories * _setting('CATEGORY_WEIGHT', 1.0)
+    return overlap * 0.5 ** (float(days_apart) / _setting('HALF_LIFE', 365))
+
+def _shared_counts(sql, params):
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+def candidate_scores(entry):
+    """
+    Returns a dictionary mapping the id of each live Entry which
+    shares a tag or Category with ``entry`` to its score.
+    
+    """
+    from tagging.models import TaggedItem
+    from coltrane.models import Entry
+    qn = connection.ops.quote_name
+    entry_table = qn(Entry._meta.db_table)
+    shared = {}
+
+    tag_table = qn(TaggedItem._meta.db_table)
+    ctype = ContentType.objects.get_for_model(Entry)
+    tag_ids = list(TaggedItem.objects.filter(content_type__pk=ctype.id, object_id=entry.id).values_list('tag', flat=True))
+    if tag_ids:
+        rows = _shared_counts("SELECT t.%s, e.%s, COUNT(*) FROM %s t INNER JOIN %s e ON e.%s = t.%s "
+                              "WHERE t.%s = %%s AND t.%s IN (%s) AND t.%s <> %%s AND e.%s = %%s "
+                              "GROUP BY t.%s, e.%s" % \
+                              (qn('object_id'), qn('pub_date'), tag_table, entry_table, qn('id'), qn('object_id'),
+                               qn('content_type_id'), qn('tag_id'), ', '.join(['%s'] * len(tag_ids)),
+                               qn('object_id'), qn('status'), qn('object_id'), qn('pub_date')),
+                              [ctype.id] + tag_ids + [entry.id, Entry.LIVE_STATUS])
+        for object_id, pub_date, count in rows:
+            shared[object_id] = [pub_date, count, 0]
+
+    field = Entry._meta.get_field('categories')
+    category_ids = list(entry.categories.values_list('id', flat=True))
+    if category_ids:
+        entry_column, category_column = qn(field.m2m_column_name()), qn(field.m2m_reverse_name())
+        rows = _shared_counts("SELECT c.%s, e.%s, COUNT(*) FROM %s c INNER JOIN %s e ON e.%s = c.%s "
+                              "WHERE c.%s IN (%s) AND c.%s <> %%s AND e.%s = %%s "
+                              "GROUP BY c.%s, e.%s" % \
+                              (entry_column, qn('pub_date'), qn(field.m2m_db_table()), entry_table, qn('id'), entry_column,
+                               category_column, ', '.join(['%s'] * len(category_ids)),
+                               entry_column, qn('status'), entry_column, qn('pub_date')),
+                              category_ids + [entry.id, Entry.LIVE_STATUS])
+        for entry_id, pub_date, count in rows:
+            shared.setdefault(entry_id, [pub_date, 0, 0])[2] = count
+
+    scores = {}
+    for entry_id, (pub_date, tags, categories) in shared.items():
+        scores[entry_id] = score(tags, categories, abs((entry.pub_date - pub_date).days))
+    return scores
+
+def _best(scores, num):
+    ranked = [(-value, entry_id) for entry_id, value in scores.items()]
+    ranked.sort()
+    return [(entry_id, -value) for value, entry_id in ranked[:num]]
+
+def _store(entry_id, best):
+    from coltrane.models import RelatedEntry
+    RelatedEntry.objects.filter(entry__id=entry_id).delete()
+    for related_id, value in best:
+        RelatedEntry.objects.create(entry_id=entry_id, related_id=related_id, score=value)
+    purge(u'related:%s' % entry_id)
+
+def recompute_related(entry):
+    """
+    Recomputes and stores ``entry``'s list of related Entries,
+    returning the scores of all its candidates.
+    
+    """
+    if entry.status != entry.LIVE_STATUS:
+        _store(entry.id, [])
+        return {}
+    scores = candidate_scores(entry)
+    _store(entry.id, _best(scores, _setting('ENTRIES', 5)))
+    return scores
+
+def refresh_related(entry):
+    """
+    Brings the related-entry lists affected by a change to ``entry``
+    up to date.
+    
+    """
+    from coltrane.models import Entry, RelatedEntry
+    num = _setting('ENTRIES', 5)
+    scores = recompute_related(entry)
+
+    # Lists which include the Entry may rank it differently now, or
+    # need to drop it; recompute them from scratch.
+    listing = list(RelatedEntry.objects.filter(related__id=entry.id).values_list('entry', flat=True))
+    for other in Entry.objects.filter(id__in=listing):
+        recompute_related(other)
+
+    # The Entry may now belong in the lists of its best candidates.
+    top = [entry_id for entry_id, value in _best(scores, RECIPROCAL_CANDIDATES) if entry_id not in listing]
+    if not top:
+        return
+    lists = {}
+    for entry_id, related_id, value in RelatedEntry.objects.filter(entry__id__in=top).values_list('entry', 'related', 'score'):
+        lists.setdefault(entry_id, []).append((related_id, value))
+    for entry_id in top:
+        current = lists.get(entry_id, [])
+        if len(current) < num or scores[entry_id] > min([value for related_id, value in current]):
+            best = dict(current)
+            best[entry.id] = scores[entry_id]
+            _store(entry_id, _best(best, num))
+
+def update_related_entries(sender, instance, **kwargs):
+    """
+    Signal handler which refreshes related-entry lists when an Entry
+    is saved. It's called through ``coltrane.deferred``, so that the
+    scores include categories the admin writes after saving the
+    Entry. Scores depend only on the Entry's status, date, categories
+    and tags, so nothing is done when none of those changed.
+    
+    """
+    from coltrane.counters import entry_tag_ids
+    original = getattr(instance, '_original_state', None)
+    if original is not None and \
+       original['status'] == instance.status and \
+       original['pub_date'] == instance.pub_date and \
+       original['categories'] == set(instance.categories.values_list('id', flat=True)) and \
+       original['tags'] == entry_tag_ids(instance):
+        return
+    refresh_related(instance)
+
+def remember_related_listing(sender, instance, **kwargs):
+    """
+    Signal handler which, before an Entry is deleted, records which
+    Entries list it as related, since those rows are deleted along
+    with it.
+    
+    """
+    from coltrane.models import RelatedEntry
+    instance._related_listing = list(RelatedEntry.objects.filter(related__id=instance.id).values_list('entry', flat=True))
+
+def remove_related_entries(sender, instance, **kwargs):
+    """
+    Signal handler which, after an Entry is deleted, recomputes the
+    lists which included it.
+    
+    """
+    from coltrane.models import Entry
+    for other in Entry.objects.filter(id__in=getattr(instance, '_related_listing', [])):
+        recompute_related(other)
+
+def rebuild_related_entries():
+    """
+    Recomputes every live Entry's list of related Entries.
+    
+    """
+    from coltrane.models import Entry, RelatedEntry
+    RelatedEntry.objects.all().delete()
+    for entry in Entry.live.all().iterator():
+        recompute_related(entry)
@@ -0,0 +1,230 @@
+"""
+Conversion of the text fields of Entries and Categories to HTML.
+
+Normally this happens synchronously when an object is saved. If the
+``COLTRANE_ASYNC_RENDERING`` setting is ``True``, the object is
+instead saved with ``render_pending`` set, and the HTML is filled in
+afterwards by a pool of ``COLTRANE_RENDER_WORKERS`` background
+threads (default 2).
+
+Either way, each object stores a hash of its source text and the
+markup settings in ``markup_hash``, and rendering is skipped entirely
+when that hash hasn't changed. Recent renders are also kept in a
+process-wide LRU cache of ``COLTRANE_RENDER_CACHE_SIZE`` items
+(default 100), which is consulted before calling the formatter.
+
+"""
+
+import datetime
+import threading
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from django.conf import settings
+from django.core import signals as core_signals
+from django.db import transaction
+from django.dispatch import dispatcher
+from template_utils.markup import formatter
+
+from coltrane import deferred
+from coltrane.caching import bump_category_generation, bump_entry_generation
+from coltrane.pagecache import purge_rendered_pages
+from coltrane.workers import WorkerPool
+
+
+_pool = WorkerPool(getattr(settings, 'COLTRANE_RENDER_WORKERS', 2))
+
+# Jobs queued inside a request's managed transaction wait here until
+# the request finishes, so workers never look for rows that haven't
+# been committed yet.
+_deferred = threading.local()
+
+# The most recent job token for each object, so that a render which
+# finishes after a newer one was queued doesn't overwrite it.
+_latest_tokens = {}
+_tokens_lock = threading.Lock()
+
+
+class RenderCache(object):
+    """
+    A small, thread-safe, least-recently-used mapping of content
+    hashes to rendered HTML.
+    
+    """
+    def __init__(self, size):
+        self.size = size
+        self._data = {}
+        self._order = []
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            if key not in self._data:
+                return None
+            self._order.remove(key)
+            self._order.append(key)
+            return self._data[key]
+        finally:
+            self._lock.release()
+    
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            if key in self._data:
+                self._order.remove(key)
+            self._data[key] = value
+            self._order.append(key)
+            while len(self._order) > self.size:
+                del self._data[self._order.pop(0)]
+        finally:
+            self._lock.release()
+
+
+_render_cache = RenderCache(getattr(settings, 'COLTRANE_RENDER_CACHE_SIZE', 100))
+
+
+def _text_hash(*texts):
+    digest = md5(repr(getattr(settings, 'MARKUP_FILTER', None)))
+    for text in texts:
+        digest.update('\x00')
+        if text:
+            digest.update(text.encode('utf-8'))
+    return digest.hexdigest()
+
+def source_hash(sources):
+    """
+    Returns a hash of the markup settings and of ``sources``, a
+    sequence of ``(source_field, text)`` pairs.
+    
+    """
+    return _text_hash(*[source_field + u'\x00' + (text or u'') for source_field, text in sources])
+
+def markup_hash(instance, fields):
+    """
+    Returns a hash of the markup settings and of the source text of
+    ``instance``'s ``fields``, a sequence of ``(source_field,
+    html_field)`` name pairs.
+    
+    """
+    return source_hash([(source_field, getattr(instance, source_field)) for source_field, html_field in fields])
+
+def render_markup(text):
+    """
+    Converts ``text`` to HTML with the configured markup filter,
+    reusing a recent render of identical text if there is one.
+    
+    """
+    key = _text_hash(text)
+    html = _render_cache.get(key)
+    if html is None:
+        html = formatter(text)
+        _render_cache.set(key, html)
+    return html
+
+def render_sources(job):
+    """
+    Renders the text in ``job``, a tuple of an object's primary key,
+    a sequence of ``(html_field, text)`` pairs and its markup hash,
+    returning the same tuple with HTML in place of the text.
+    
+    This takes and returns a single picklable value, for use with
+    ``multiprocessing`` pools.
+    
+    """
+    pk, sources, digest = job
+    return pk, [(html_field, render_markup(text)) for html_field, text in sources], digest
+
+def _render_job(model, pk, sources, digest, token):
+    values = { 'markup_hash': digest }
+    for html_field, text in sources:
+        values[html_field] = render_markup(text)
+    _tokens_lock.acquire()
+    try:
+        if _latest_tokens.get((model, pk)) != token:
+            return
+        del _latest_tokens[(model, pk)]
+    finally:
+        _tokens_lock.release()
+    if 'last_modified' in [f.name for f in model._meta.fields]:
+        values['last_modified'] = datetime.datetime.now()
+    model.objects.filter(pk=pk).update(render_pending=False, **values)
+    bump_category_generation()
+    bump_entry_generation()
+    purge_rendered_pages(model, pk)
+
+def _submit_deferred(**kwargs):
+    jobs = getattr(_deferred, 'jobs', [])
+    _deferred.jobs = []
+    for job in jobs:
+        _pool.submit(_render_job, *job)
+
+def queue_render(instance, fields):
+    """
+    Queues the conversion of the saved ``instance``'s text fields to
+    HTML; ``fields`` is a sequence of ``(source_field, html_field)``
+    name pairs.
+    
+    Inside a managed transaction, the job waits until the current
+    request has finished and its transaction has been committed.
+    Outside a request (say, in a script using ``commit_on_success``
+    or a management command) there's no point at which the commit is
+    known to have happened, so the HTML is rendered and written
+    straight away, in the same transaction.
+    
+    """
+    model = instance.__class__
+    _tokens_lock.acquire()
+    try:
+        token = object()
+        _latest_tokens[(model, instance.pk)] = token
+    finally:
+        _tokens_lock.release()
+    job = (model, instance.pk,
+           [(html_field, getattr(instance, source_field)) for source_field, html_field in fields],
+           markup_hash(instance, fields), token)
+    if transaction.is_managed() and deferred.in_request():
+        if not hasattr(_deferred, 'jobs'):
+            _deferred.jobs = []
+        _deferred.jobs.append(job)
+    elif transaction.is_managed():
+        _render_job(*job)
+    else:
+        _pool.submit(_render_job, *job)
+
+def save_rendered(instance, fields, save):
+    """
+    Fills in the HTML versions of ``instance``'s text fields, then
+    saves it by calling ``save``; ``fields`` is a sequence of
+    ``(source_field, html_field)`` name pairs.
+
+    With asynchronous rendering enabled, ``instance`` is saved with
+    ``render_pending`` set to ``True`` and its HTML fields are
+    updated in the database (without sending save signals) once
+    they've been rendered.
+    
+    If the source text and markup settings haven't changed since the
+    HTML was last rendered, as recorded in ``instance.markup_hash``,
+    ``instance`` is just saved; unless a render is still pending, in
+    which case it's rendered again, so that the pending one (of some
+    other text) is superseded.
+    
+    """
+    digest = markup_hash(instance, fields)
+    if digest == instance.markup_hash and not instance.render_pending:
+        save()
+    elif getattr(settings, 'COLTRANE_ASYNC_RENDERING', False):
+        instance.render_pending = True
+        save()
+        queue_render(instance, fields)
+    else:
+        for source_field, html_field in fields:
+            setattr(instance, html_field, render_markup(getattr(instance, source_field)))
+        instance.markup_hash = digest
+        instance.render_pending = False
+        save()
+
+dispatcher.connect(_submit_deferred, signal=core_signals.request_finished)
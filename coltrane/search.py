@@ -0,0 +1,265 @@
+"""
+Full-text search over live Entries.
+
+Each live Entry's title, excerpt and body are split into words,
+which are lowercased, stripped of common suffixes and stored as
+postings in the ``SearchPosting`` model: one row per term per Entry,
+with the term's (weighted) frequency and its word positions. The
+index is updated from signal handlers whenever an Entry is saved or
+deleted, and can be rebuilt with ``manage.py coltrane_rebuild
+search``.
+
+Queries match Entries containing every term, ranked by TF-IDF with a
+bonus for terms appearing next to each other in the order given.
+
+"""
+
+import math
+import re
+
+from django.db import connection, transaction
+
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+STOP_WORDS = frozenset(('a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for',
+                        'from', 'has', 'have', 'he', 'i', 'if', 'in', 'into', 'is', 'it',
+                        'its', 'not', 'of', 'on', 'or', 'she', 'so', 'such', 'that', 'the',
+                        'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was',
+                        'we', 'were', 'will', 'with', 'you'))
+
+# Suffixes stripped by ``stem``, longest first, with their
+# replacements.
+SUFFIXES = (('ational', 'ate'), ('ization', 'ize'), ('fulness', 'ful'),
+            ('iveness', 'ive'), ('ousness', 'ous'), ('tional', 'tion'),
+            ('ations', 'ate'), ('ation', 'ate'), ('ments', ''), ('ment', ''),
+            ('ness', ''), ('ings', ''), ('ing', ''), ('ies', 'y'), ('ied', 'y'),
+            ('ers', ''), ('ed', ''), ('er', ''), ('ly', ''), ('es', ''), ('s', ''))
+
+# Title words count this many times towards a term's frequency.
+TITLE_WEIGHT = 3
+
+# Gap left between the positions of words in different fields, so
+# that phrases aren't matched across them.
+FIELD_GAP = 10
+
+MAX_TERM_LENGTH = 50
+
+# Above this many candidate Entries, postings are intersected in
+# Python rather than with an ``IN`` clause.
+MAX_IN_CLAUSE = 500
+
+# Bonus added to an Entry's score for each pair of query terms which
+# appear next to each other, in order.
+PHRASE_BONUS = 1.0
+
+
+def stem(word):
+    """
+    Strips a common English suffix from ``word``, so that related
+    forms of a word ("index", "indexes", "indexing") share a term.
+
+    This is a deliberately simple suffix stripper rather than a full
+    stemming algorithm; it only needs to be consistent.
+    
+    """
+    if len(word) <= 3 or word.endswith('ss'):
+        return word
+    for suffix, replacement in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)] + replacement
+    return word
+
+def analyze(text):
+    """
+    Returns the list of index terms in ``text``, in order.
+    
+    """
+    terms = []
+    for word in WORD_RE.findall((text or u'').lower()):
+        if word in STOP_WORDS:
+            continue
+        terms.append(stem(word)[:MAX_TERM_LENGTH])
+    return terms
+
+def entry_postings(entry):
+    """
+    Returns a dictionary mapping each term in ``entry`` to a
+    ``(frequency, positions)`` pair.
+    
+    """
+    postings = {}
+    position = 0
+    for text, weight in ((entry.title, TITLE_WEIGHT), (entry.excerpt, 1), (entry.body, 1)):
+        for term in analyze(text):
+            frequency, positions = postings.get(term, (0, []))
+            positions.append(position)
+            postings[term] = (frequency + weight, positions)
+            position += 1
+        position += FIELD_GAP
+    return postings
+
+def _delete_postings(entry_ids):
+    from coltrane.models import SearchPosting
+    SearchPosting.objects.filter(entry__id__in=entry_ids).delete()
+
+def index_entries(entries):
+    """
+    Replaces the postings of each of ``entries``; Entries which
+    aren't live are removed from the index.
+    
+    """
+    from coltrane.models import SearchPosting
+    qn = connection.ops.quote_name
+    entries = list(entries)
+    if not entries:
+        return
+    _delete_postings([entry.id for entry in entries])
+    rows = []
+    for entry in entries:
+        if entry.status != entry.LIVE_STATUS:
+            continue
+        for term, (frequency, positions) in entry_postings(entry).items():
+            rows.append((term, entry.id, frequency, u' '.join([str(p) for p in positions])))
+    if rows:
+        opts = SearchPosting._meta
+        columns = [qn(opts.get_field(name).column) for name in ('term', 'entry', 'frequency', 'positions')]
+        cursor = connection.cursor()
+        cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % \
+                           (qn(opts.db_table), ', '.join(columns), ', '.join(['%s'] * len(columns))),
+                           rows)
+    transaction.commit_unless_managed()
+
+def update_search_index(sender, instance, **kwargs):
+    """
+    Signal handler which reindexes an Entry when it's saved.
+    
+    """
+    index_entries([instance])
+
+def remove_from_search_index(sender, instance, **kwargs):
+    """
+    Signal handler which removes an Entry's postings when it's
+    deleted.
+    
+    """
+    _delete_postings([instance.id])
+
+def rebuild_search_index(chunk_size=200):
+    """
+    Throws away the whole search index and rebuilds it from the live
+    Entries, ``chunk_size`` at a time.
+    
+    """
+    from coltrane.models import Entry, SearchPosting
+    SearchPosting.objects.all().delete()
+    last_id = 0
+    while True:
+        entries = list(Entry.live.filter(id__gt=last_id).order_by('id')[:chunk_size])
+        if not entries:
+            break
+        index_entries(entries)
+        last_id = entries[-1].id
+
+
+class SearchResults(object):
+    """
+    One page of results for a search.
+
+    ``object_list`` holds the live Entries on the page, best match
+    first, and ``hits`` the total number of matching Entries.
+    
+    """
+    def __init__(self, query, terms, object_list, hits, page, per_page):
+        self.query = query
+        self.terms = terms
+        self.object_list = object_list
+        self.hits = hits
+        self.page = page
+        self.per_page = per_page
+        self.pages = max(int(math.ceil(float(hits) / per_page)), 1)
+        self.has_next = page < self.pages
+        self.has_previous = page > 1
+
+    def context(self):
+        """
+        Returns the template context variables for this page of
+        results.
+        
+        """
+        return { 'query': self.query,
+                 'object_list': self.object_list,
+                 'hits': self.hits,
+                 'page': self.page,
+                 'pages': self.pages,
+                 'has_next': self.has_next,
+                 'has_previous': self.has_previous,
+                 'next': self.page + 1,
+                 'previous': self.page - 1 }
+
+
+def _phrase_matches(first, second):
+    following = set([position + 1 for position in first])
+    for position in second:
+        if position in following:
+            return True
+    return False
+
+def search(query, page=1, per_page=10):
+    """
+    Returns a ``SearchResults`` for page ``page`` (counting from 1) of
+    the live Entries containing every term in ``query``.
+    
+    """
+    from coltrane.models import Entry, SearchPosting
+    ordered_terms = analyze(query)
+    terms = list(set(ordered_terms))
+    if not terms:
+        return SearchResults(query, [], [], 0, page, per_page)
+
+    # Intersect postings starting from the rarest term, so that each
+    # further lookup is restricted to the Entries still matching.
+    qn = connection.ops.quote_name
+    opts = SearchPosting._meta
+    cursor = connection.cursor()
+    cursor.execute("SELECT %s, COUNT(*) FROM %s WHERE %s IN (%s) GROUP BY %s" % \
+                   (qn('term'), qn(opts.db_table), qn('term'),
+                    ', '.join(['%s'] * len(terms)), qn('term')),
+                   terms)
+    document_frequency = dict(cursor.fetchall())
+    if len(document_frequency) < len(terms):
+        return SearchResults(query, terms, [], 0, page, per_page)
+    terms.sort(key=lambda term: document_frequency[term])
+    postings = {}
+    candidates = None
+    for term in terms:
+        rows = SearchPosting.objects.filter(term=term)
+        if candidates is not None and len(candidates) <= MAX_IN_CLAUSE:
+            rows = rows.filter(entry__id__in=candidates.keys())
+        found = {}
+        for entry_id, frequency, positions in rows.values_list('entry', 'frequency', 'positions'):
+            if candidates is not None and entry_id not in candidates:
+                continue
+            found[entry_id] = True
+            postings[(term, entry_id)] = (frequency, [int(p) for p in positions.split()])
+        candidates = found
+        if not candidates:
+            return SearchResults(query, terms, [], 0, page, per_page)
+
+    total = max(Entry.live.count(), 1)
+    scores = []
+    for entry_id in candidates:
+        score = 0.0
+        for term in terms:
+            frequency, positions = postings[(term, entry_id)]
+            score += (1 + math.log(frequency)) * math.log(1 + float(total) / document_frequency[term])
+        for first, second in zip(ordered_terms, ordered_terms[1:]):
+            if _phrase_matches(postings[(first, entry_id)][1], postings[(second, entry_id)][1]):
+                score += PHRASE_BONUS
+        scores.append((-score, -entry_id))
+    scores.sort()
+    page_ids = [-entry_id for score, entry_id in scores[(page - 1) * per_page:page * per_page]]
+    entries = Entry.live.in_bulk(page_ids)
+    return SearchResults(query, terms,
+                         [entries[entry_id] for entry_id in page_ids if entry_id in entries],
+                         len(scores), page, per_page)
@@ -0,0 +1,11 @@
+-- Composite indexes matching the queries made through LiveEntryManager:
+-- live entries by date, live featured entries by date, and the entry
+-- detail lookup by slug within a publication date range.
+--
+-- Django runs this file when the coltrane tables are created by syncdb.
+-- To add the indexes to an existing installation, run:
+--
+--     python manage.py sqlcustom coltrane | python manage.py dbshell
+CREATE INDEX coltrane_entry_status_pub_date ON coltrane_entry (status, pub_date);
+CREATE INDEX coltrane_entry_status_featured_pub_date ON coltrane_entry (status, featured, pub_date);
+CREATE INDEX coltrane_entry_slug_pub_date ON coltrane_entry (slug, pub_date);
@@ -0,0 +1,32 @@
+-- Statements which bring the tables of an existing coltrane
+-- installation up to date. syncdb creates new tables, but never adds
+-- columns to existing ones, so run the statements below for the
+-- columns your tables don't have yet, then create any new tables and
+-- fill in the new columns:
+--
+--     python manage.py dbshell < coltrane/sql/upgrade.sql
+--     python manage.py syncdb
+--     python manage.py coltrane_rebuild
+--
+-- The statements are written for PostgreSQL. On MySQL, use "datetime"
+-- for "timestamp with time zone"; on SQLite, use 0 for false and
+-- CURRENT_TIMESTAMP for now(). The file isn't named after a model, so
+-- syncdb never runs it on a fresh install.
+
+-- Denormalized comment counts.
+ALTER TABLE coltrane_entry ADD COLUMN comment_count integer NOT NULL DEFAULT 0;
+
+-- Background rendering of markup.
+ALTER TABLE coltrane_category ADD COLUMN render_pending boolean NOT NULL DEFAULT false;
+ALTER TABLE coltrane_entry ADD COLUMN render_pending boolean NOT NULL DEFAULT false;
+
+-- Hashes of rendered markup sources.
+ALTER TABLE coltrane_category ADD COLUMN markup_hash varchar(32) NOT NULL DEFAULT '';
+ALTER TABLE coltrane_entry ADD COLUMN markup_hash varchar(32) NOT NULL DEFAULT '';
+
+-- Modification times for conditional GET.
+ALTER TABLE coltrane_entry ADD COLUMN last_modified timestamp with time zone NOT NULL DEFAULT now();
+CREATE INDEX coltrane_entry_last_modified ON coltrane_entry (last_modified);
+
+-- Maintained counts of live entries per Category.
+ALTER TABLE coltrane_category ADD COLUMN live_entry_count integer NOT NULL DEFAULT 0;
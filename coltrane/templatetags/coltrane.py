@@ -1,27 +1,123 @@
+from django.core.cache import cache
 from django.db.models import get_model
+from django.db.models.query import QuerySet
 from django import template
 from django.contrib.comments.models import Comment, FreeComment
+from tagging.utils import calculate_cloud
 from template_utils.templatetags.generic_content import GenericContentNode
 
-from coltrane.models import Entry, Link
+from coltrane import pagecache
+from coltrane.archive import archive_periods
+from coltrane.caching import entry_cache_key, is_shared
+from coltrane.models import Category, Entry, TagCount
 
 
 register = template.Library()
 
 
 class LatestFeaturedNode(GenericContentNode):
+    """
+    Retrieves the latest featured entries, caching the result for
+    the current Entry generation so that it's only looked up again
+    after an Entry is saved or deleted (or after ``timeout`` seconds,
+    if given). Nothing is cached unless the cache backend is shared.
+    
+    """
+    def __init__(self, model, num, varname, timeout=None):
+        super(LatestFeaturedNode, self).__init__(model, num, varname)
+        self.timeout = timeout
+    
     def _get_query_set(self):
         return self.queryset.filter(featured__exact=True)
+    
+    def render(self, context):
+        pagecache.depends_on('featured')
+        key = entry_cache_key('featured.%s' % self.num)
+        cached = is_shared() and cache.get(key) or None
+        if cached is None:
+            super(LatestFeaturedNode, self).render(context)
+            result = context[self.varname]
+            if isinstance(result, QuerySet):
+                result = list(result)
+            cached = (result,)
+            if is_shared():
+                cache.set(key, cached, self.timeout)
+        context[self.varname] = cached[0]
+        return ''
+
+
+class ArchivePeriodsNode(template.Node):
+    def __init__(self, kind, category, varname):
+        self.kind = kind
+        self.category = category and template.Variable(category) or None
+        self.varname = varname
+    
+    def render(self, context):
+        category = None
+        if self.category is not None:
+            category = self.category.resolve(context)
+        pagecache.depends_on('archive')
+        context[self.varname] = archive_periods(self.kind, category=category)
+        return ''
+
+
+class RelatedEntriesNode(template.Node):
+    def __init__(self, entry, varname):
+        self.entry = template.Variable(entry)
+        self.varname = varname
+    
+    def render(self, context):
+        context[self.varname] = self.entry.resolve(context).get_related()
+        return ''
+
+
+class LiveCategoriesNode(template.Node):
+    def __init__(self, varname):
+        self.varname = varname
+    
+    def render(self, context):
+        pagecache.depends_on('categories')
+        context[self.varname] = list(Category.objects.filter(live_entry_count__gt=0))
+        return ''
+
 
+class TagCloudNode(template.Node):
+    def __init__(self, varname, steps):
+        self.varname = varname
+        self.steps = steps
+    
+    def render(self, context):
+        pagecache.depends_on('tags')
+        tags = []
+        for row in TagCount.objects.select_related().order_by('tag__name'):
+            tag = row.tag
+            tag.count = row.live_entry_count
+            tags.append(tag)
+        context[self.varname] = calculate_cloud(tags, self.steps)
+        return ''
+
+
+def _timeout_arg(bits, index):
+    if len(bits) <= index:
+        return None
+    try:
+        return int(bits[index])
+    except ValueError:
+        raise template.TemplateSyntaxError("timeout argument to '%s' tag must be a number of seconds" % bits[0])
 
 def do_featured_entries(parser, token):
     """
     Retrieves the latest ``num`` featured entries and stores them in a
     specified context variable.
     
+    The entries are cached until an Entry is saved or deleted; an
+    optional final argument sets a timeout, in seconds, after which
+    they're looked up again regardless.
+    
     Syntax::
     
         {% get_featured_entries [num] as [varname] %}
+        {% get_featured_entries [num] as [varname] [timeout] %}
     
     Example::
     
@@ -29,32 +125,156 @@ def do_featured_entries(parser, token):
     
     """
     bits = token.contents.split()
-    if len(bits) != 4:
-        raise template.TemplateSyntaxError("'%s' tag takes three arguments" % bits[0])
+    if len(bits) not in (4, 5):
+        raise template.TemplateSyntaxError("'%s' tag takes three or four arguments" % bits[0])
     if bits[2] != 'as':
         raise template.TemplateSyntaxError("second argument to '%s' tag must be 'as'" % bits[0])
-    return LatestFeaturedNode('coltrane.entry', bits[1], bits[3])
+    return LatestFeaturedNode('coltrane.entry', bits[1], bits[3], _timeout_arg(bits, 4))
 
 def do_featured_entry(parser, token):
     """
     Retrieves the latest featured Entry and stores it in a specified
     context variable.
     
+    The Entry is cached until an Entry is saved or deleted; an
+    optional final argument sets a timeout, in seconds, after which
+    it's looked up again regardless.
+    
     Syntax::
     
         {% get_featured_entry as [varname] %}
+        {% get_featured_entry as [varname] [timeout] %}
     
     Example::
     
         {% get_featured_entry as featured_entry %}
     
+    """
+    bits = token.contents.split()
+    if len(bits) not in (3, 4):
+        raise template.TemplateSyntaxError("'%s' tag takes two or three arguments" % bits[0])
+    if bits[1] != 'as':
+        raise template.TemplateSyntaxError("first argument to '%s' tag must be 'as'" % bits[0])
+    return LatestFeaturedNode('coltrane.entry', 1, bits[2], _timeout_arg(bits, 3))
+
+def do_archive_periods(parser, token):
+    """
+    Retrieves the years, months or days which have live entries,
+    optionally only those in a given ``Category``, and stores them in
+    a specified context variable.
+    
+    The list is read from the precomputed archive index and is in
+    chronological order; each item has a ``date`` attribute (a
+    ``datetime.datetime``) and an ``entry_count`` attribute.
+    
+    Syntax::
+    
+        {% get_archive_periods [year|month|day] as [varname] %}
+        {% get_archive_periods [year|month|day] for [category] as [varname] %}
+    
+    Example::
+    
+        {% get_archive_periods month as archive_months %}
+    
+    """
+    bits = token.contents.split()
+    if len(bits) not in (4, 6):
+        raise template.TemplateSyntaxError("'%s' tag takes three or five arguments" % bits[0])
+    if bits[1] not in ('year', 'month', 'day'):
+        raise template.TemplateSyntaxError("first argument to '%s' tag must be 'year', 'month' or 'day'" % bits[0])
+    category = None
+    if len(bits) == 6:
+        if bits[2] != 'for':
+            raise template.TemplateSyntaxError("second argument to '%s' tag must be 'for'" % bits[0])
+        category = bits[3]
+    if bits[-2] != 'as':
+        raise template.TemplateSyntaxError("next-to-last argument to '%s' tag must be 'as'" % bits[0])
+    return ArchivePeriodsNode(bits[1], category, bits[-1])
+
+def do_related_entries(parser, token):
+    """
+    Retrieves the live entries most closely related to an Entry by
+    shared tags and categories, best match first, and stores them in
+    a specified context variable.
+    
+    The list is read from the precomputed related-entry table, so it
+    costs a single query.
+    
+    Syntax::
+    
+        {% get_related_entries [entry] as [varname] %}
+    
+    Example::
+    
+        {% get_related_entries object as related_entries %}
+    
+    """
+    bits = token.contents.split()
+    if len(bits) != 4:
+        raise template.TemplateSyntaxError("'%s' tag takes three arguments" % bits[0])
+    if bits[2] != 'as':
+        raise template.TemplateSyntaxError("second argument to '%s' tag must be 'as'" % bits[0])
+    return RelatedEntriesNode(bits[1], bits[3])
+
+def do_live_categories(parser, token):
+    """
+    Retrieves the categories which have live entries, in title
+    order, and stores them in a specified context variable.
+    
+    Each category's ``live_entry_count`` is maintained as entries
+    change, so the list and its counts cost a single query.
+    
+    Syntax::
+    
+        {% get_live_categories as [varname] %}
+    
+    Example::
+    
+        {% get_live_categories as category_list %}
+    
     """
     bits = token.contents.split()
     if len(bits) != 3:
         raise template.TemplateSyntaxError("'%s' tag takes two arguments" % bits[0])
     if bits[1] != 'as':
         raise template.TemplateSyntaxError("first argument to '%s' tag must be 'as'" % bits[0])
-    return LatestFeaturedNode('coltrane.entry', 1, bits[2])
+    return LiveCategoriesNode(bits[2])
+
+def do_tag_cloud(parser, token):
+    """
+    Retrieves the tags applied to live entries, in alphabetical
+    order, and stores them in a specified context variable.
+    
+    Each tag has a ``count`` attribute, read from the maintained
+    per-tag counts, and a ``font_size`` attribute between 1 and the
+    number of steps given (default 4).
+    
+    Syntax::
+    
+        {% get_tag_cloud as [varname] %}
+        {% get_tag_cloud as [varname] [steps] %}
+    
+    Example::
+    
+        {% get_tag_cloud as tag_cloud 6 %}
+    
+    """
+    bits = token.contents.split()
+    if len(bits) not in (3, 4):
+        raise template.TemplateSyntaxError("'%s' tag takes two or three arguments" % bits[0])
+    if bits[1] != 'as':
+        raise template.TemplateSyntaxError("first argument to '%s' tag must be 'as'" % bits[0])
+    steps = 4
+    if len(bits) == 4:
+        try:
+            steps = int(bits[3])
+        except ValueError:
+            raise template.TemplateSyntaxError("steps argument to '%s' tag must be a number" % bits[0])
+    return TagCloudNode(bits[2], steps)
 
 register.tag('get_featured_entries', do_featured_entries)
 register.tag('get_featured_entry', do_featured_entry)
+register.tag('get_archive_periods', do_archive_periods)
+register.tag('get_related_entries', do_related_entries)
+register.tag('get_live_categories', do_live_categories)
+register.tag('get_tag_cloud', do_tag_cloud)
@@ -7,12 +7,13 @@ from django.conf.urls.defaults import *
 from django.views.generic.list_detail import object_list
 
 from coltrane.models import Category
+from coltrane.pagecache import cache_page, category_list_tags
 from coltrane.views import category_detail
 
 
 urlpatterns = patterns('',
                        url(r'^$',
-                           object_list,
+                           cache_page(category_list_tags)(object_list),
                            { 'queryset': Category.objects.all() },
                            name='coltrane_category_list'),
                        url(r'^(?P<slug>[-\w]+)/$',
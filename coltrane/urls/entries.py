@@ -6,34 +6,42 @@ URLs for entries in a weblog.
 from django.conf.urls.defaults import *
 from django.views.generic import date_based
 
+from coltrane.conditional import archive_validators, condition, entry_validators
 from coltrane.models import Entry
+from coltrane.pagecache import archive_tags, cache_page, entry_tags
+from coltrane.views import entry_archive_index, entry_archive_year
 
 
 entry_info_dict = {
+    'queryset': Entry.live.summary().with_categorization(),
+    'date_field': 'pub_date',
+    }
+
+entry_detail_dict = {
     'queryset': Entry.live.all(),
     'date_field': 'pub_date',
+    'slug_field': 'slug',
     }
 
 
 urlpatterns = patterns('',
                        url(r'^$',
-                           date_based.archive_index,
-                           entry_info_dict,
+                           entry_archive_index,
                            name='coltrane_entry_archive_index'),
                        url(r'^(?P<year>\d{4})/$',
-                           date_based.archive_year,
-                           dict(entry_info_dict, make_object_list=True),
+                           entry_archive_year,
+                           { 'make_object_list': True },
                            name='coltrane_entry_archive_year'),
                        url(r'^(?P<year>\d{4})/(?P<month>\w{3})/$',
-                           date_based.archive_month,
+                           cache_page(archive_tags)(condition(archive_validators)(date_based.archive_month)),
                            entry_info_dict,
                            name='coltrane_entry_archive_month'),
                        url(r'^(?P<year>\d{4})/(?P<month>\w{3})/(?P<day>\d{2})/$',
-                           date_based.archive_day,
+                           cache_page(archive_tags)(condition(archive_validators)(date_based.archive_day)),
                            entry_info_dict,
                            name='coltrane_entry_archive_day'),
                        url(r'^(?P<year>\d{4})/(?P<month>\w{3})/(?P<day>\d{2})/(?P<slug>[-\w]+)/$',
-                           date_based.object_detail,
-                           dict(entry_info_dict, slug_field='slug'),
+                           cache_page(entry_tags)(condition(entry_validators)(date_based.object_detail)),
+                           entry_detail_dict,
                            name='coltrane_entry_detail'),
                        )
@@ -0,0 +1,15 @@
+"""
+URLs for syndication feeds of a weblog.
+
+"""
+
+from django.conf.urls.defaults import *
+
+from coltrane.feeds import feed
+
+
+urlpatterns = patterns('',
+                       url(r'^(?P<url>.*)/$',
+                           feed,
+                           name='coltrane_feed'),
+                       )
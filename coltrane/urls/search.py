@@ -0,0 +1,15 @@
+"""
+URLs for searching a weblog.
+
+"""
+
+from django.conf.urls.defaults import *
+
+from coltrane.views import search
+
+
+urlpatterns = patterns('',
+                       url(r'^$',
+                           search,
+                           name='coltrane_search'),
+                       )
@@ -1,12 +1,26 @@
 import datetime
 
 from django.conf import settings
-from django.shortcuts import get_object_or_404, render_to_response
+from django.http import Http404, HttpResponse
+from django.shortcuts import render_to_response
+from django.template import loader, RequestContext
 from django.views.generic import date_based, list_detail
 
-from coltrane.models import Category
+from coltrane.archive import archive_dates
+from coltrane.caching import get_category
+from coltrane.conditional import archive_validators, category_validators, condition
+from coltrane.models import Category, Entry
+from coltrane.pagecache import archive_tags, cache_page, category_tags
+from coltrane.pagination import keyset_page_for_request
+from coltrane.search import search as search_entries
 
 
+def _get_category(slug):
+    try:
+        return get_category(slug)
+    except Category.DoesNotExist:
+        raise Http404("No category found for slug '%s'" % slug)
+
 def _category_kwarg_helper(category, kwarg_dict):
     if 'extra_context' in kwarg_dict:
         kwarg_dict['extra_context'].update(object=category)
@@ -17,7 +31,121 @@ def _category_kwarg_helper(category, kwarg_dict):
             del kwarg_dict[key]
     return kwarg_dict
 
-def category_detail(request, slug, **kwargs):
+def _render(request, template_name, context, template_loader=loader,
+            extra_context=None, context_processors=None, mimetype=None):
+    c = RequestContext(request, context, context_processors)
+    for key, value in (extra_context or {}).items():
+        if callable(value):
+            c[key] = value()
+        else:
+            c[key] = value
+    t = template_loader.get_template(template_name)
+    return HttpResponse(t.render(c), mimetype=mimetype)
+
+def _archive_index(request, queryset, category, template_name,
+                   num_latest=15, allow_empty=False, allow_future=False, keyset=False, **kwargs):
+    date_list = archive_dates('year', category=category, allow_future=allow_future)
+    date_list.reverse()
+    if not date_list and not allow_empty:
+        raise Http404("No entries available")
+    if not allow_future:
+        queryset = queryset.filter(pub_date__lte=datetime.datetime.now())
+    context = { 'date_list': date_list, 'latest': None }
+    if date_list and num_latest:
+        if keyset:
+            page = keyset_page_for_request(request, queryset, num_latest)
+            context.update(page.context())
+            context['latest'] = page.object_list
+        else:
+            context['latest'] = queryset.order_by('-pub_date')[:num_latest]
+    return _render(request, template_name, context, **kwargs)
+
+def _archive_year(request, year, queryset, category, template_name,
+                  allow_empty=False, allow_future=False, make_object_list=False,
+                  template_object_name='object', **kwargs):
+    date_list = archive_dates('month', category=category, year=year, allow_future=allow_future)
+    if not date_list and not allow_empty:
+        raise Http404
+    lookup_kwargs = { 'pub_date__year': year }
+    if int(year) >= datetime.date.today().year and not allow_future:
+        lookup_kwargs['pub_date__lte'] = datetime.datetime.now()
+    object_list = []
+    if make_object_list:
+        object_list = queryset.filter(**lookup_kwargs)
+    return _render(request, template_name,
+                   { 'date_list': date_list,
+                     'year': year,
+                     '%s_list' % template_object_name: object_list },
+                   **kwargs)
+
+def entry_archive_index(request, template_name='coltrane/entry_archive.html', **kwargs):
+    """
+    View of the latest live entries, with a list of the years which
+    have entries.
+    
+    This is a replacement for the generic ``date_based.archive_index``
+    view which reads ``date_list`` from the precomputed archive index
+    instead of querying for it, and accepts the same keyword
+    arguments, except ``queryset`` and ``date_field``. The context is
+    the same::
+    
+        date_list
+            A list of ``datetime.datetime`` objects for each year
+            with live entries, most recent first.
+    
+        latest
+            The latest ``num_latest`` live entries.
+    
+    If the ``keyset`` keyword argument is ``True``, ``latest`` is
+    instead a page of ``num_latest`` entries selected by an opaque
+    ``after`` or ``before`` cursor in the query string, and these
+    variables are added::
+    
+        has_next, has_previous
+            Whether there are older or newer entries.
+    
+        next_cursor, previous_cursor
+            The cursors to pass as ``after`` and ``before``
+            respectively to reach them.
+    
+    Template::
+        coltrane/entry_archive.html
+    
+    """
+    return _archive_index(request, Entry.live.summary().with_categorization(), None, template_name, **kwargs)
+entry_archive_index = cache_page(archive_tags)(condition(archive_validators)(entry_archive_index))
+
+def entry_archive_year(request, year, template_name='coltrane/entry_archive_year.html', **kwargs):
+    """
+    View of live entries published in a given year, with a list of
+    the months which have entries.
+    
+    This is a replacement for the generic ``date_based.archive_year``
+    view which reads ``date_list`` from the precomputed archive index
+    instead of querying for it, and accepts the same keyword
+    arguments, except ``queryset`` and ``date_field``. The context is
+    the same::
+    
+        date_list
+            A list of ``datetime.datetime`` objects for each month in
+            the year with live entries.
+    
+        year
+            The year.
+    
+        object_list
+            The live entries published in the year, if
+            ``make_object_list`` is ``True``; otherwise, an empty
+            list.
+    
+    Template::
+        coltrane/entry_archive_year.html
+    
+    """
+    return _archive_year(request, year, Entry.live.summary().with_categorization(), None, template_name, **kwargs)
+entry_archive_year = cache_page(archive_tags)(condition(archive_validators)(entry_archive_year))
+
+def category_detail(request, slug, keyset=False, **kwargs):
     """
     Detail view of a ``Category``, listing entries published in it.
     
@@ -37,32 +165,49 @@ def category_detail(request, slug, **kwargs):
       the ``Category``.
     * ``template_name`` will always be 'coltrane/category_detail.html'.
     
+    If the ``keyset`` keyword argument is ``True``, entries are instead
+    paginated by an opaque ``after`` or ``before`` cursor in the query
+    string rather than a page number, ``paginate_by`` (default 20) at
+    a time, without counting the entries in the ``Category``. The
+    context then has ``object_list``, ``is_paginated``, ``has_next``,
+    ``has_previous``, ``next_cursor`` and ``previous_cursor``.
+    
     Template::
         coltrane/category_detail.html
     
     """
-    category = get_object_or_404(Category, slug__exact=slug)
+    category = _get_category(slug)
     kwarg_dict = _category_kwarg_helper(category, kwargs)
+    if keyset:
+        page = keyset_page_for_request(request,
+                                       category.live_entry_set.summary().with_categorization(),
+                                       kwarg_dict.pop('paginate_by', None) or 20)
+        context = page.context(kwarg_dict.pop('template_object_name', 'object'))
+        for key in ('allow_empty', 'page'):
+            kwarg_dict.pop(key, None)
+        return _render(request, 'coltrane/category_detail.html', context, **kwarg_dict)
     return list_detail.object_list(request,
-                                   queryset=category.live_entry_set,
+                                   queryset=category.live_entry_set.summary().with_categorization(),
                                    template_name='coltrane/category_detail.html',
                                    **kwarg_dict)
+category_detail = cache_page(category_tags)(condition(category_validators)(category_detail))
 
 def category_archive_index(request, slug, **kwargs):
     """
     View of the latest entries published in a ``Category``.
     
-    This is a short wrapper around the generic
-    ``date_based.archive_index`` view, so all context variables
-    populated by that view will be available here. One extra variable
-    is added::
+    This works like ``entry_archive_index``, reading ``date_list``
+    from the precomputed archive index for the ``Category``, so all
+    context variables populated by the generic
+    ``date_based.archive_index`` view will be available here. One
+    extra variable is added::
     
         object
             The ``Category``.
     
     Additionally, any keyword arguments which are valid for
-    ``date_based.archive_year`` will be accepted and passed to it,
-    with these exceptions:
+    ``date_based.archive_index`` will be accepted, with these
+    exceptions:
     
     * ``queryset`` will always be the ``QuerySet`` of live entries in
       the ``Category``.
@@ -73,29 +218,30 @@ def category_archive_index(request, slug, **kwargs):
         coltrane/category_archive.html
     
     """
-    category = get_object_or_404(Category, slug__exact=slug)
+    category = _get_category(slug)
     kwarg_dict = _category_kwarg_helper(category, kwargs)
-    return date_based.archive_index(request,
-                                    queryset=category.live_entry_set,
-                                    date_field='pub_date',
-                                    template_name='coltrane/category_archive.html',
-                                    **kwarg_dict)
+    return _archive_index(request,
+                          category.live_entry_set.summary().with_categorization(),
+                          category,
+                          'coltrane/category_archive.html',
+                          **kwarg_dict)
+category_archive_index = cache_page(category_tags)(condition(category_validators)(category_archive_index))
 
 def category_archive_year(request, slug, year, **kwargs):
     """
     View of entries published in a ``Category`` in a given year.
     
-    This is a short wrapper around the generic
-    ``date_based.archive_year`` view, so all context variables
-    populated by that view will be available here. One extra variable
-    is added::
+    This works like ``entry_archive_year``, reading ``date_list`` from
+    the precomputed archive index for the ``Category``, so all context
+    variables populated by the generic ``date_based.archive_year``
+    view will be available here. One extra variable is added::
     
         object
             The ``Category``.
     
     Additionally, any keyword arguments which are valid for
-    ``date_based.archive_year`` will be accepted and passed to it,
-    with these exceptions:
+    ``date_based.archive_year`` will be accepted, with these
+    exceptions:
     
     * ``queryset`` will always be the ``QuerySet`` of live entries in
       the ``Category``.
@@ -106,14 +252,15 @@ def category_archive_year(request, slug, year, **kwargs):
         coltrane/category_archive_year.html
     
     """
-    category = get_object_or_404(Category, slug__exact=slug)
+    category = _get_category(slug)
     kwarg_dict = _category_kwarg_helper(category, kwargs)
-    return date_based.archive_year(request,
-                                   year=year,
-                                   queryset=category.live_entry_set,
-                                   date_field='pub_date',
-                                   template_name='coltrane/category_archive_year.html',
-                                   **kwarg_dict)
+    return _archive_year(request,
+                         year,
+                         category.live_entry_set.summary().with_categorization(),
+                         category,
+                         'coltrane/category_archive_year.html',
+                         **kwarg_dict)
+category_archive_year = cache_page(category_tags)(condition(category_validators)(category_archive_year))
 
 def category_archive_month(request, slug, year, month, **kwargs):
     """
@@ -140,15 +287,16 @@ def category_archive_month(request, slug, year, month, **kwargs):
         coltrane/category_archive_month.html
     
     """
-    category = get_object_or_404(Category, slug__exact=slug)
+    category = _get_category(slug)
     kwarg_dict = _category_kwarg_helper(category, kwargs)
     return date_based.archive_month(request,
                                     year=year,
                                     month=month,
-                                    queryset=category.live_entry_set,
+                                    queryset=category.live_entry_set.summary().with_categorization(),
                                     date_field='pub_date',
                                     template_name='coltrane/category_archive_month.html',
                                     **kwarg_dict)
+category_archive_month = cache_page(category_tags)(condition(category_validators)(category_archive_month))
 
 def category_archive_day(request, slug, year, month, day, **kwargs):
     """
@@ -175,16 +323,17 @@ def category_archive_day(request, slug, year, month, day, **kwargs):
         coltrane/category_archive_day.html
     
     """
-    category = get_object_or_404(Category, slug__exact=slug)
+    category = _get_category(slug)
     kwarg_dict = _category_kwarg_helper(category, kwargs)
     return date_based.archive_day(request,
                                  year=year,
                                  month=month,
                                  day=day,
-                                 queryset=category.live_entry_set,
+                                 queryset=category.live_entry_set.summary().with_categorization(),
                                  date_field='pub_date',
                                  template_name='coltrane/category_archive_day.html',
                                  **kwarg_dict)
+category_archive_day = cache_page(category_tags)(condition(category_validators)(category_archive_day))
 
 def category_archive_today(request, slug, **kwargs):
     """
@@ -218,3 +367,47 @@ def category_archive_today(request, slug, **kwargs):
                                 month = today.strftime('%b').lower(),
                                 day = today.strftime('%d'),
                                 **kwargs)
+
+def search(request, template_name='coltrane/search.html', paginate_by=10, **kwargs):
+    """
+    Search results for the query in the ``q`` GET parameter, drawn
+    from the full-text index of live entries.
+    
+    Context::
+    
+        query
+            The query, or an empty string if none was given.
+    
+        object_list
+            The matching entries on this page, best match first.
+    
+        hits
+            The total number of matching entries.
+    
+        page, pages
+            The current page number (given in the ``page`` GET
+            parameter) and the number of pages.
+    
+        has_next, has_previous, next, previous
+            Whether there are further or earlier pages, and their
+            page numbers.
+    
+    Any further keyword arguments (``extra_context``,
+    ``context_processors``, ``template_loader`` and ``mimetype``) are
+    handled as in the generic views.
+    
+    Template::
+        coltrane/search.html
+    
+    """
+    query = request.GET.get('q', '').strip()
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        raise Http404
+    if page < 1:
+        raise Http404
+    results = search_entries(query, page, paginate_by)
+    if page > results.pages:
+        raise Http404
+    return _render(request, template_name, results.context(), **kwargs)
@@ -0,0 +1,62 @@
+"""
+A minimal pool of background worker threads, for work which
+shouldn't hold up a request but doesn't need an external task
+queue.
+
+"""
+
+import logging
+import Queue
+import threading
+
+from django.db import connection
+
+
+class WorkerPool(object):
+    """
+    A fixed number of daemon threads, started on first use, which
+    run functions submitted to the pool one at a time.
+
+    Each worker closes its database connection after every task, so
+    tasks always see committed data and idle workers don't hold
+    connections open. Exceptions raised by tasks are logged to the
+    'coltrane' logger and otherwise ignored.
+    
+    """
+    def __init__(self, num_workers=2):
+        self.num_workers = num_workers
+        self.queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.num_workers:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            try:
+                try:
+                    func(*args, **kwargs)
+                except Exception:
+                    logging.getLogger('coltrane').exception('Background task %r failed' % func)
+            finally:
+                connection.close()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues ``func`` to be called with ``args`` and ``kwargs`` in a
+        worker thread.
+        
+        """
+        if len(self._threads) < self.num_workers:
+            self._start()
+        self.queue.put((func, args, kwargs))